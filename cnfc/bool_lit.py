@@ -1,11 +1,29 @@
+# There are only two boolean literals, True and False: BooleanLiteral(val)
+# always returns one of those two instances.
 class BooleanLiteral:
-    def __init__(self, val):
+    __slots__ = ('val',)
+    instances = {}
+
+    def __new__(cls, val):
         assert type(val) == bool
-        self.val = val
+        instance = cls.instances.get(val)
+        if instance is None:
+            instance = super().__new__(cls)
+            instance.val = val
+            cls.instances[val] = instance
+        return instance
 
     def __repr__(self):
         return 'BooleanLiteral({})'.format(self.val)
 
+    @property
+    def sid(self):
+        return int(self.val)
+
+    @property
+    def key(self):
+        return self.sid
+
     def __invert__(self):
         return BooleanLiteral(not self.val)
 
@@ -1,26 +1,163 @@
 # Buffers to store clauses during formula creation and simplification.
+from array import array
+from collections import deque
+from itertools import islice
+import codecs
+import io
+import json
+import multiprocessing
 import os
+import shutil
+import stat
 import tempfile
 
+# Returns the OS-level file descriptor behind fd if fd is a text file opened
+# directly on a regular file with the given encoding, so that we can copy a
+# spool file into it without going through Python. Returns None otherwise:
+# compressed streams, for example, also have a fileno(), but writing to it
+# would bypass the compressor.
+def raw_output_fileno(fd, encoding):
+    if not isinstance(fd, io.TextIOWrapper): return None
+    if not isinstance(fd.buffer, (io.BufferedWriter, io.BufferedRandom)): return None
+    if not isinstance(fd.buffer.raw, io.FileIO): return None
+    if codecs.lookup(fd.encoding).name != codecs.lookup(encoding).name: return None
+    fileno = fd.fileno()
+    if not stat.S_ISREG(os.fstat(fileno).st_mode): return None
+    return fileno
+
+# Copies up to count bytes starting at offset in infd to the current position
+# of outfd, in the kernel if possible. Returns the number of bytes copied.
+def copy_range(infd, outfd, offset, count):
+    if hasattr(os, 'copy_file_range'):
+        try:
+            return os.copy_file_range(infd, outfd, count, offset)
+        except OSError:
+            pass  # e.g., EXDEV on older kernels. Try sendfile instead.
+    if hasattr(os, 'sendfile'):
+        try:
+            return os.sendfile(outfd, infd, offset, count)
+        except OSError:
+            pass  # e.g., macOS only supports sending to sockets.
+    os.lseek(infd, offset, os.SEEK_SET)
+    return os.write(outfd, os.read(infd, min(count, 2**20)))
+
+# Writes the contents of the text spool file at path to fd without ever holding
+# more than a chunk of it in memory. The caller must flush any writes to the
+# spool file first.
+def copy_spool(path, encoding, fd):
+    with open(path, 'rb') as src:
+        outfd = raw_output_fileno(fd, encoding)
+        if outfd is None:
+            text = io.TextIOWrapper(src, encoding=encoding)
+            shutil.copyfileobj(text, fd)
+            text.detach()  # src is closed by the with statement.
+            return
+        fd.flush()
+        infd = src.fileno()
+        offset, size = 0, os.fstat(infd).st_size
+        while offset < size:
+            copied = copy_range(infd, outfd, offset, size - offset)
+            if copied == 0: break
+            offset += copied
+        # Let fd know where the OS-level writes left its position.
+        fd.seek(os.lseek(outfd, 0, os.SEEK_CUR))
+
+# Formats a sequence of clauses as DIMACS text, one clause per line.
+def format_clauses(clauses):
+    return ''.join(["{} 0\n".format(' '.join(str(lit) for lit in clause)) for clause in clauses])
+
+# Formats clauses stored ArrayBuffer-style as DIMACS text. lits is a slice of a
+# flat literal array that starts at index base of the original, and offsets are
+# the (unadjusted) clause boundaries within it. Instead of joining each clause
+# separately, we convert every literal to a string in one pass, tack the clause
+# terminator onto the last literal of each clause and join everything at once.
+def format_array_clauses(lits, offsets, base):
+    strs = list(map(str, lits))
+    prev = offsets[0]
+    for end in islice(offsets, 1, len(offsets)):
+        # An empty clause has no literal to attach its terminator to.
+        if end == prev:
+            return format_clauses(tuple(lits[s-base:e-base])
+                                  for s, e in zip(offsets, islice(offsets, 1, len(offsets))))
+        strs[end-base-1] += ' 0\n'
+        prev = end
+    return ' '.join(strs).replace('\n ', '\n')
+
+# Splits clauses stored ArrayBuffer-style into jobs for write_formatted that
+# format n clauses each.
+def array_format_jobs(lits, offsets, n):
+    for i in range(0, len(offsets) - 1, n):
+        bounds = offsets[i:i+n+1]
+        yield format_array_clauses, (lits[bounds[0]:bounds[-1]], bounds, bounds[0])
+
+# Returns the largest variable in a sequence of literals, or 0 if it's empty.
+def max_var(lits):
+    return max(max(lits, default=0), -min(lits, default=0))
+
+# Shifts the clause boundaries in offsets so that they start at base.
+def rebased_offsets(offsets, base):
+    shift = base - offsets[0]
+    return array('q', (end + shift for end in islice(offsets, 1, len(offsets))))
+
+def apply_formatter(job):
+    formatter, args = job
+    return formatter(*args)
+
+# Writes the text for each (formatter, args) job to fd in order. With more than
+# one worker, jobs are formatted in a process pool, keeping only a few chunks
+# in flight at once so memory use stays bounded.
+def write_formatted(fd, jobs, workers=None):
+    if workers is None or workers <= 1:
+        for job in jobs:
+            fd.write(apply_formatter(job))
+        return
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.apply_async(apply_formatter, (job,)))
+            if len(pending) >= 2 * workers:
+                fd.write(pending.popleft().get())
+        while pending:
+            fd.write(pending.popleft().get())
+
 class MemoryBuffer:
+    # Number of clauses formatted at a time by Flush.
+    flush_chunk_size = 2**16
+
     def __init__(self, maxvar=None):
         self.comments = []
         self.clauses = []
         self.maxvar = 0 if maxvar is None else maxvar
         self.checkpoints = []
 
+    @property
+    def num_clauses(self):
+        return len(self.clauses)
+
+    # Returns a new, empty buffer of the same kind and settings, starting at
+    # our maxvar. Simplification builds its output buffers this way.
+    def Empty(self):
+        return self.__class__(maxvar=self.maxvar)
+
     def PushCheckpoint(self):
         self.checkpoints.append((len(self.clauses), len(self.comments), self.maxvar))
 
     def PopCheckpoint(self):
         num_clauses, num_comments, self.maxvar = self.checkpoints.pop()
-        self.clauses = self.clauses[:num_clauses]
-        self.comments = self.comments[:num_comments]
+        # Truncate in place so popping only costs O(clauses removed).
+        del self.clauses[num_clauses:]
+        del self.comments[num_comments:]
 
     def Append(self, clause):
         if len(clause) > 0: self.maxvar = max(self.maxvar, *[abs(lit) for lit in clause])
         self.clauses.append(clause)
 
+    # Appends many clauses at once, given ArrayBuffer-style: the literals of
+    # clause i are lits[offsets[i]:offsets[i+1]].
+    def Extend(self, lits, offsets):
+        self.maxvar = max(self.maxvar, max_var(lits[offsets[0]:offsets[-1]]))
+        self.clauses.extend(tuple(lits[start:end]) for start, end in zip(offsets, islice(offsets, 1, len(offsets))))
+
     def AllClauses(self):
         yield from self.clauses
 
@@ -30,14 +167,102 @@ class MemoryBuffer:
     def AllComments(self):
         yield from self.comments
 
-    def Flush(self, fd):
+    # If workers > 1, clauses are formatted in a pool of that many processes.
+    # header replaces the usual "p cnf" line, if given.
+    def Flush(self, fd, workers=None, header=None):
         for comment in self.AllComments():
             fd.write("c {}\n".format(comment))
-        fd.write('p cnf {} {}\n'.format(self.maxvar, len(self.clauses)))
-        for clause in self.AllClauses():
-            fd.write("{} 0\n".format(' '.join(str(lit) for lit in clause)))
+        if header is None:
+            header = 'p cnf {} {}\n'.format(self.maxvar, len(self.clauses))
+        fd.write(header)
+        n = self.flush_chunk_size
+        jobs = ((format_clauses, (self.clauses[i:i+n],)) for i in range(0, len(self.clauses), n))
+        write_formatted(fd, jobs, workers)
+
+# Like MemoryBuffer, but stores all literals in a single flat array of C ints
+# instead of one tuple per clause. offsets[i] is the index in lits where clause
+# i starts, and offsets[-1] is always len(lits). A 3-literal clause costs about
+# 20 bytes here versus 150+ bytes as a tuple of Python ints in a list.
+class ArrayBuffer:
+    # Number of clauses formatted at a time by Flush.
+    flush_chunk_size = 2**16
+
+    def __init__(self, maxvar=None):
+        self.comments = []
+        self.lits = array('i')
+        self.offsets = array('q', [0])
+        self.maxvar = 0 if maxvar is None else maxvar
+        self.checkpoints = []
+
+    @property
+    def num_clauses(self):
+        return len(self.offsets) - 1
+
+    def Empty(self):
+        return self.__class__(maxvar=self.maxvar)
+
+    def PushCheckpoint(self):
+        self.checkpoints.append((self.num_clauses, len(self.comments), self.maxvar))
+
+    def PopCheckpoint(self):
+        num_clauses, num_comments, self.maxvar = self.checkpoints.pop()
+        del self.lits[self.offsets[num_clauses]:]
+        del self.offsets[num_clauses+1:]
+        del self.comments[num_comments:]
+
+    def Append(self, clause):
+        if len(clause) > 0: self.maxvar = max(self.maxvar, *[abs(lit) for lit in clause])
+        self.lits.extend(clause)
+        self.offsets.append(len(self.lits))
+
+    def Extend(self, lits, offsets):
+        self.maxvar = max(self.maxvar, max_var(lits[offsets[0]:offsets[-1]]))
+        self.offsets.extend(rebased_offsets(offsets, len(self.lits)))
+        self.lits.extend(lits[offsets[0]:offsets[-1]])
+
+    def AllClauses(self):
+        lits, offsets = self.lits, self.offsets
+        for start, end in zip(offsets, islice(offsets, 1, len(offsets))):
+            yield tuple(lits[start:end])
+
+    def AddComment(self, comment):
+        self.comments.append(comment)
+
+    def AllComments(self):
+        yield from self.comments
+
+    # If workers > 1, clauses are formatted in a pool of that many processes.
+    # header replaces the usual "p cnf" line, if given.
+    def Flush(self, fd, workers=None, header=None):
+        for comment in self.AllComments():
+            fd.write("c {}\n".format(comment))
+        if header is None:
+            header = 'p cnf {} {}\n'.format(self.maxvar, self.num_clauses)
+        fd.write(header)
+        write_formatted(fd, array_format_jobs(self.lits, self.offsets, self.flush_chunk_size), workers)
+
+# Replays the first size bytes of a file of DIMACS clauses, one per line as
+# FileBuffer writes them, every line ending in " 0\n". Rather than parse line
+# by line, each chunk of whole lines is rewritten into a JSON list of lists
+# ("1 -2 0\n3 0\n" becomes "[[1,-2],[3]]") and parsed in one call.
+def read_dimacs_clauses(path, size, chunk_size):
+    with open(path, 'rb') as f:
+        pending = b''
+        while size > 0:
+            chunk = f.read(min(chunk_size, size))
+            if not chunk: break
+            size -= len(chunk)
+            pending += chunk
+            end = pending.rfind(b'\n') + 1
+            if end == 0: continue
+            body = pending[:end].replace(b' 0\n', b'],[').replace(b' ', b',')
+            pending = pending[end:]
+            yield from map(tuple, json.loads(b'[[' + body[:-2] + b']'))
 
 class FileBuffer:
+    # Number of bytes read from the clause file at a time by AllClauses.
+    chunk_size = 2**20
+
     def __init__(self, maxvar=None):
         # We keep two file descriptors:
         #    * fd, which is where we write the raw clauses in DIMACS CNF format,
@@ -60,6 +285,9 @@ class FileBuffer:
             self.cfd.close()
             os.remove(self.cpath)
 
+    def Empty(self):
+        return self.__class__(maxvar=self.maxvar)
+
     def PushCheckpoint(self):
         self.checkpoints.append((self.num_clauses, self.maxvar, self.fd.tell(), self.cfd.tell()))
 
@@ -75,10 +303,18 @@ class FileBuffer:
         self.num_clauses += 1
         self.fd.write("{} 0\n".format(' '.join(str(lit) for lit in clause)))
 
+    def Extend(self, lits, offsets):
+        self.maxvar = max(self.maxvar, max_var(lits[offsets[0]:offsets[-1]]))
+        self.num_clauses += len(offsets) - 1
+        self.fd.write(format_array_clauses(lits[offsets[0]:offsets[-1]], offsets, offsets[0]))
+
     def AllClauses(self):
-        self.fd.seek(0)
-        for line in self.fd:
-            yield tuple(int(lit) for lit in line.split()[:-1])
+        # Read through a separate handle, so the write position of self.fd is
+        # left alone, and only up to the current end of the file: clauses
+        # appended while we iterate aren't replayed, and if a checkpoint pop
+        # truncates the file, reading just stops early.
+        self.fd.flush()
+        yield from read_dimacs_clauses(self.fpath, os.fstat(self.fd.fileno()).st_size, self.chunk_size)
 
     def AddComment(self, comment):
         self.cfd.write("c {}\n".format(comment))
@@ -88,9 +324,281 @@ class FileBuffer:
         for comment in self.cfd:
             yield comment[2:-1]
 
-    def Flush(self, fd):
+    # header replaces the usual "p cnf" line, if given. workers is ignored:
+    # clauses are always written serially.
+    def Flush(self, fd, workers=None, header=None):
+        self.cfd.flush()
+        copy_spool(self.cpath, self.cfd.encoding, fd)
+        if header is None:
+            header = 'p cnf {} {}\n'.format(self.maxvar, self.num_clauses)
+        fd.write(header)
+        self.fd.flush()
+        copy_spool(self.fpath, self.fd.encoding, fd)
+
+# Replays the clauses in a file of records written by write_records. We read
+# through a separate handle so that clauses appended to the file while we're
+# iterating don't disturb the position of the handle used for writing.
+def read_records(path, chunk_size):
+    with open(path, 'rb') as f:
+        pending = array('i')
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk: break
+            pending.frombytes(chunk)
+            i, n = 0, len(pending)
+            while i < n:
+                end = i + 1 + pending[i]
+                if end > n: break
+                yield tuple(pending[i+1:end])
+                i = end
+            del pending[:i]
+
+# Writes clauses stored ArrayBuffer-style (flat lits plus offsets) to fd as
+# records: the clause length followed by its literals, all native C ints.
+def write_records(fd, lits, offsets):
+    records = array('i')
+    for start, end in zip(offsets, islice(offsets, 1, len(offsets))):
+        records.append(end - start)
+        records.extend(lits[start:end])
+    fd.write(records.tobytes())
+
+# Like FileBuffer, but clauses are spooled to disk as packed binary records
+# instead of DIMACS text: each record is the clause length followed by its
+# literals, all native C ints. Replaying clauses only needs to reinterpret the
+# bytes read from disk, no parsing. DIMACS text is only produced in Flush.
+class BinaryFileBuffer:
+    # Number of bytes read from the clause file at a time by AllClauses.
+    chunk_size = 2**20
+
+    def __init__(self, maxvar=None):
+        self.fd, self.cfd = None, None
+        fd, self.fpath = tempfile.mkstemp()
+        self.fd = os.fdopen(fd, 'w+b')
+        cfd, self.cpath = tempfile.mkstemp()
+        self.cfd = os.fdopen(cfd, 'w+')
+        self.maxvar = 0 if maxvar is None else maxvar
+        self.num_clauses = 0
+        self.checkpoints = []
+
+    def __del__(self):
+        if self.fd is not None:
+            self.fd.close()
+            os.remove(self.fpath)
+        if self.cfd is not None:
+            self.cfd.close()
+            os.remove(self.cpath)
+
+    def Empty(self):
+        return self.__class__(maxvar=self.maxvar)
+
+    def PushCheckpoint(self):
+        self.checkpoints.append((self.num_clauses, self.maxvar, self.fd.tell(), self.cfd.tell()))
+
+    def PopCheckpoint(self):
+        self.num_clauses, self.maxvar, fpos, cfpos = self.checkpoints.pop()
+        self.fd.seek(fpos)
+        self.fd.truncate()
+        self.cfd.seek(cfpos)
+        self.cfd.truncate()
+
+    def Append(self, clause):
+        if len(clause) > 0: self.maxvar = max(self.maxvar, *[abs(lit) for lit in clause])
+        self.num_clauses += 1
+        record = array('i', (len(clause),))
+        record.extend(clause)
+        self.fd.write(record.tobytes())
+
+    def Extend(self, lits, offsets):
+        self.maxvar = max(self.maxvar, max_var(lits[offsets[0]:offsets[-1]]))
+        self.num_clauses += len(offsets) - 1
+        write_records(self.fd, lits, offsets)
+
+    def AllClauses(self):
+        self.fd.flush()
+        yield from read_records(self.fpath, self.chunk_size)
+
+    def AddComment(self, comment):
+        self.cfd.write("c {}\n".format(comment))
+
+    def AllComments(self):
         self.cfd.seek(0)
-        fd.write(self.cfd.read())
-        fd.write('p cnf {} {}\n'.format(self.maxvar, self.num_clauses))
-        self.fd.seek(0)
-        fd.write(self.fd.read())
+        for comment in self.cfd:
+            yield comment[2:-1]
+
+    # header replaces the usual "p cnf" line, if given. workers is ignored:
+    # clauses are always written serially.
+    def Flush(self, fd, workers=None, header=None):
+        self.cfd.flush()
+        copy_spool(self.cpath, self.cfd.encoding, fd)
+        if header is None:
+            header = 'p cnf {} {}\n'.format(self.maxvar, self.num_clauses)
+        fd.write(header)
+        for clause in self.AllClauses():
+            fd.write("{} 0\n".format(' '.join(str(lit) for lit in clause)))
+
+# Keeps clauses in memory like ArrayBuffer until the in-memory arrays grow past
+# memory_budget bytes, then spills them to a temporary file of records in the
+# same format as BinaryFileBuffer and starts filling memory again. Clauses on
+# disk always precede clauses in memory. Comments are always kept in memory.
+#
+# Empty() carries memory_budget over, so the budget survives simplification.
+class HybridBuffer:
+    memory_budget = 2**28
+    chunk_size = 2**20
+
+    def __init__(self, maxvar=None, memory_budget=None):
+        if memory_budget is not None:
+            self.memory_budget = memory_budget
+        self.comments = []
+        self.lits = array('i')
+        self.offsets = array('q', [0])
+        # The spill file is only created once we go over budget.
+        self.fd, self.fpath = None, None
+        self.spilled_clauses, self.spilled_lits = 0, 0
+        self.maxvar = 0 if maxvar is None else maxvar
+        self.checkpoints = []
+
+    def __del__(self):
+        if self.fd is not None:
+            self.fd.close()
+            os.remove(self.fpath)
+
+    @property
+    def num_clauses(self):
+        return self.spilled_clauses + len(self.offsets) - 1
+
+    @property
+    def memory_used(self):
+        return self.lits.itemsize * len(self.lits) + self.offsets.itemsize * len(self.offsets)
+
+    def Spill(self):
+        if self.fd is None:
+            fd, self.fpath = tempfile.mkstemp()
+            self.fd = os.fdopen(fd, 'w+b')
+        write_records(self.fd, self.lits, self.offsets)
+        self.spilled_clauses = self.num_clauses
+        self.spilled_lits += len(self.lits)
+        self.lits = array('i')
+        self.offsets = array('q', [0])
+
+    # Keeps the budget, unlike constructing a new buffer with just maxvar.
+    def Empty(self):
+        return self.__class__(maxvar=self.maxvar, memory_budget=self.memory_budget)
+
+    def PushCheckpoint(self):
+        self.checkpoints.append(
+            (self.num_clauses, self.spilled_lits + len(self.lits), len(self.comments), self.maxvar))
+
+    def PopCheckpoint(self):
+        num_clauses, num_lits, num_comments, self.maxvar = self.checkpoints.pop()
+        del self.comments[num_comments:]
+        if num_clauses >= self.spilled_clauses:
+            num_clauses -= self.spilled_clauses
+            del self.lits[self.offsets[num_clauses]:]
+            del self.offsets[num_clauses+1:]
+            return
+        # The checkpoint is on disk. Each record before it takes one int for
+        # its length plus one per literal.
+        self.fd.seek(self.lits.itemsize * (num_clauses + num_lits))
+        self.fd.truncate()
+        self.spilled_clauses, self.spilled_lits = num_clauses, num_lits
+        self.lits = array('i')
+        self.offsets = array('q', [0])
+
+    def Append(self, clause):
+        if len(clause) > 0: self.maxvar = max(self.maxvar, *[abs(lit) for lit in clause])
+        self.lits.extend(clause)
+        self.offsets.append(len(self.lits))
+        if self.memory_used > self.memory_budget:
+            self.Spill()
+
+    def Extend(self, lits, offsets):
+        self.maxvar = max(self.maxvar, max_var(lits[offsets[0]:offsets[-1]]))
+        self.offsets.extend(rebased_offsets(offsets, len(self.lits)))
+        self.lits.extend(lits[offsets[0]:offsets[-1]])
+        if self.memory_used > self.memory_budget:
+            self.Spill()
+
+    def AllClauses(self):
+        if self.spilled_clauses > 0:
+            self.fd.flush()
+            yield from read_records(self.fpath, self.chunk_size)
+        lits, offsets = self.lits, self.offsets
+        for start, end in zip(offsets, islice(offsets, 1, len(offsets))):
+            yield tuple(lits[start:end])
+
+    def AddComment(self, comment):
+        self.comments.append(comment)
+
+    def AllComments(self):
+        yield from self.comments
+
+    # header replaces the usual "p cnf" line, if given. workers is ignored:
+    # clauses are always written serially.
+    def Flush(self, fd, workers=None, header=None):
+        for comment in self.AllComments():
+            fd.write("c {}\n".format(comment))
+        if header is None:
+            header = 'p cnf {} {}\n'.format(self.maxvar, self.num_clauses)
+        fd.write(header)
+        for clause in self.AllClauses():
+            fd.write("{} 0\n".format(' '.join(str(lit) for lit in clause)))
+
+# A buffer that doesn't store anything: it only counts clauses, literals and
+# comments and keeps a histogram of clause lengths. Running a formula into it
+# sizes the encoding in constant memory (apart from the expression cache),
+# but there's nothing to read back, so AllClauses and Flush aren't supported.
+class CountingBuffer:
+    def __init__(self, maxvar=None):
+        self.maxvar = 0 if maxvar is None else maxvar
+        self.num_clauses = 0
+        self.num_literals = 0
+        self.num_comments = 0
+        self.lengths = {}
+        self.checkpoints = []
+
+    def Empty(self):
+        return self.__class__(maxvar=self.maxvar)
+
+    def PushCheckpoint(self):
+        self.checkpoints.append((self.num_clauses, self.num_literals, self.num_comments,
+                                 dict(self.lengths), self.maxvar))
+
+    def PopCheckpoint(self):
+        (self.num_clauses, self.num_literals, self.num_comments,
+         self.lengths, self.maxvar) = self.checkpoints.pop()
+
+    def Append(self, clause):
+        n = len(clause)
+        if n > 0: self.maxvar = max(self.maxvar, *[abs(lit) for lit in clause])
+        self.num_clauses += 1
+        self.num_literals += n
+        self.lengths[n] = self.lengths.get(n, 0) + 1
+
+    def Extend(self, lits, offsets):
+        self.maxvar = max(self.maxvar, max_var(lits[offsets[0]:offsets[-1]]))
+        self.num_clauses += len(offsets) - 1
+        self.num_literals += offsets[-1] - offsets[0]
+        for start, end in zip(offsets, islice(offsets, 1, len(offsets))):
+            self.lengths[end - start] = self.lengths.get(end - start, 0) + 1
+
+    def AllClauses(self):
+        raise NotImplementedError('CountingBuffer does not store clauses')
+
+    def AddComment(self, comment):
+        self.num_comments += 1
+
+    def AllComments(self):
+        raise NotImplementedError('CountingBuffer does not store comments')
+
+    def Flush(self, fd, workers=None, header=None):
+        raise NotImplementedError('CountingBuffer does not store clauses')
+
+    def Stats(self):
+        return {
+            'clauses': self.num_clauses,
+            'literals': self.num_literals,
+            'maxvar': self.maxvar,
+            'comments': self.num_comments,
+            'lengths': dict(sorted(self.lengths.items())),
+        }
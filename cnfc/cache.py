@@ -1,13 +1,174 @@
-import hashlib
+# Hash-consing and caching for expressions.
+#
+# Every compound expression gets a structural id (sid) when it's constructed,
+# computed from its class and the ids of its children. Expressions that are
+# structurally identical and alive at the same time are the same object, so
+# the expression cache can key on sid in O(1) instead of hashing repr(expr),
+# which walks the whole subexpression.
+from abc import ABCMeta
+from collections import OrderedDict
+from itertools import count
+import weakref
 
+# Compound expressions get negative sids, in order of creation, and never reuse
+# one. Variables, literals and boolean literals compute non-negative sids from
+# their values (see model.py and bool_lit.py).
+_sids = count(-1, -1)
+_nodes = weakref.WeakValueDictionary()
+
+# The part of a hash-consing key that a child contributes: the child's own
+# key if it's an expression, otherwise the (hashable) value itself.
+def key_of(x):
+    try:
+        return x.key
+    except AttributeError:
+        return (type(x), x)
+
+class HashConsed(ABCMeta):
+    def __call__(cls, *args, **kwargs):
+        node = super().__call__(*args, **kwargs)
+        key = (cls,) + node._structure_key()
+        try:
+            shared = _nodes.get(key)
+        except TypeError:  # Something in the structure isn't hashable.
+            node.sid = next(_sids)
+            return node
+        if shared is not None:
+            return shared
+        node.sid = next(_sids)
+        _nodes[key] = node
+        return node
+
+def sid_of(x):
+    return getattr(x, 'sid', 0)
+
+# Base class for compound expressions. Subclasses define _structure to return
+# everything that determines the expression: its children and any plain values
+# like ints or strings.
+#
+# Operands of commutative operators are sorted by sid before hashing and
+# duplicate operands of idempotent operators are dropped, so that, e.g.,
+# And(x, y), And(y, x) and And(x, y, x) all end up as the same expression.
+class Interned(metaclass=HashConsed):
+    commutative = False
+    idempotent = False
+
+    @property
+    def key(self):
+        return self.sid
+
+    def _structure(self):
+        raise NotImplementedError  # Subclasses implement this
+
+    # The compound expressions that generating this one generates variables
+    # or bits for (see compiler.py). Subclasses override this when that's not
+    # simply the compound expressions in their structure.
+    def _operands(self):
+        return [x for x in self._structure() if isinstance(x, Interned)]
+
+    def _structure_key(self):
+        structure = self._structure()
+        if not self.commutative:
+            return tuple(key_of(x) for x in structure)
+        keys = [key_of(x) for x in sorted(structure, key=sid_of)]
+        if self.idempotent:
+            keys = [k for i, k in enumerate(keys) if i == 0 or k != keys[i-1]]
+        return tuple(keys)
+
+# Maps sids of expressions to the variable (or bits) generated for them.
+# Entries hold on to the expression itself so that its sid stays in use: if we
+# let it die, rebuilding the same expression later gets a new sid and misses.
+#
+# With a max_size, the least recently used entries are evicted once the cache
+# grows past it. An evicted expression just gets encoded again the next time
+# it shows up, so a smaller cache trades duplicate gates for memory.
+#
+# Scopes follow the formula's checkpoints: entries put after PushScope refer to
+# clauses that the matching PopCheckpoint throws away, so PopScope drops them
+# and keeps everything from before the push.
+class ExpressionCache:
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.scopes = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, expr):
+        return expr.sid in self.entries
+
+    def Get(self, expr):
+        entry = self.entries.get(expr.sid)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.max_size is not None: self.entries.move_to_end(expr.sid)
+        return entry[1]
+
+    def Put(self, expr, value):
+        self.entries[expr.sid] = (expr, value)
+        if self.scopes: self.scopes[-1].append(expr.sid)
+        if self.max_size is not None:
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def Clear(self):
+        self.entries.clear()
+        self.scopes = [[] for scope in self.scopes]
+
+    def PushScope(self):
+        self.scopes.append([])
+
+    def PopScope(self):
+        for sid in self.scopes.pop():
+            self.entries.pop(sid, None)
+
+    def Stats(self):
+        return {'size': len(self.entries), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+# While Formula.Add runs, formula.compiled maps the sid of every expression
+# generated so far in that call to its result (see compiler.py). It's checked
+# before the expression cache and, unlike it, never evicts, so results stay
+# put until the Add is done even if the cache is small or turned off.
 def cached_generate_var(method):
     def wrapper(self, formula):
-        if formula.expression_cache is None:
-            return method(self, formula)
-        key = hashlib.sha256(repr(self).encode()).hexdigest()
-        cached = formula.expression_cache.get(key)
-        if cached is not None: return cached
-        v = method(self, formula)
-        formula.expression_cache[key] = v
+        compiled, cache = formula.compiled, formula.expression_cache
+        if compiled is not None:
+            v = compiled.get(self.sid)
+            if v is not None: return v
+        v = None if cache is None else cache.Get(self)
+        if v is None:
+            v = method(self, formula)
+            if cache is not None: cache.Put(self, v)
+        if compiled is not None: compiled[self.sid] = v
         return v
+    wrapper.cached = True
+    return wrapper
+
+# Like cached_generate_var, but for the evaluate methods of tuple expressions,
+# which return a list of bits. No expression has both methods, so both share
+# the same cache. Callers are free to modify the list they get back, so we
+# hand out copies.
+def cached_evaluate(method):
+    def wrapper(self, formula):
+        compiled, cache = formula.compiled, formula.expression_cache
+        if compiled is not None:
+            bits = compiled.get(self.sid)
+            if bits is not None: return list(bits)
+        bits = None if cache is None else cache.Get(self)
+        if bits is None:
+            bits = method(self, formula)
+            if not isinstance(bits, list): return bits
+            bits = tuple(bits)
+            if cache is not None: cache.Put(self, bits)
+        if compiled is not None: compiled[self.sid] = bits
+        return list(bits)
+    wrapper.cached = True
     return wrapper
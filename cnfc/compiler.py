@@ -0,0 +1,44 @@
+# An explicit-stack compiler for expressions.
+#
+# generate_var, generate_cnf and evaluate all recurse into an expression's
+# operands, so deeply nested expressions (long If chains, nested Implies, the
+# digit loops in funcs.IsPalindrome) hit Python's recursion limit. Before we
+# generate clauses for an expression, compile_operands walks the DAG below it
+# in post-order with an explicit stack and generates each operand bottom-up.
+# Each result goes in formula.compiled, which Formula.Add keeps for the
+# duration of the call, and by the time a node's own generate_var or evaluate
+# runs, everything it calls on its operands is found there, so the recursion
+# never goes more than a level or two deep.
+#
+# formula.compiled is separate from the expression cache on purpose: the cache
+# may be off, or small enough to evict an operand before its parent gets to
+# it, which would bring back both the recursion and duplicate gates.
+
+# Generates node's variable or bits, if the result would be cached.
+def compile_node(node, formula):
+    method = getattr(node, 'evaluate', None) or getattr(node, 'generate_var', None)
+    if getattr(method, 'cached', False):
+        method(formula)
+
+# Generates everything below expr, but not expr itself: the caller decides
+# whether it needs expr's variable or its clauses.
+def compile_operands(expr, formula):
+    if not hasattr(expr, '_operands'):
+        return
+    compiled, cache = formula.compiled, formula.expression_cache
+    visited = set()
+    stack = [(operand, False) for operand in reversed(expr._operands())]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            compile_node(node, formula)
+            continue
+        if node.sid in visited or node.sid in compiled: continue
+        visited.add(node.sid)
+        if cache is not None and node in cache:
+            # Copy it over now, before compiling the rest can evict it.
+            compile_node(node, formula)
+            continue
+        stack.append((node, True))
+        stack.extend((operand, False) for operand in reversed(node._operands())
+                     if operand.sid not in visited)
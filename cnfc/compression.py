@@ -0,0 +1,64 @@
+# Streaming compression for DIMACS output. Buffers write to the returned
+# stream a line or chunk at a time, so the full text is never held in memory.
+from contextlib import contextmanager
+import bz2
+import gzip
+import io
+import lzma
+import os
+
+CODECS = {
+    'gzip': gzip.open,
+    'bz2': bz2.open,
+    'lzma': lzma.open,
+}
+
+EXTENSIONS = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'lzma',
+    '.lzma': 'lzma',
+}
+
+def compression_for_path(path):
+    return EXTENSIONS.get(os.path.splitext(os.fspath(path))[1].lower())
+
+# Yields a text stream that writes to target, compressed with the given codec.
+# target can be a path, in which case the codec defaults to one matching the
+# extension of the path, or a file object, in which case nothing is compressed
+# unless a codec is named. File objects can be text or binary, but compressing
+# into a text stream needs one with a binary buffer underneath (so not, e.g.,
+# io.StringIO). File objects passed in are never closed.
+@contextmanager
+def open_output(target, compression=None):
+    if compression is not None and compression not in CODECS:
+        raise ValueError('Unknown compression {}, expected one of {}'.format(compression, ', '.join(CODECS)))
+    if isinstance(target, (str, os.PathLike)):
+        if compression is None:
+            compression = compression_for_path(target)
+        opener = open if compression is None else CODECS[compression]
+        with opener(target, 'wt') as out:
+            yield out
+        return
+    binary = isinstance(target, (io.RawIOBase, io.BufferedIOBase)) or 'b' in getattr(target, 'mode', '')
+    if compression is None:
+        if not binary:
+            yield target
+            return
+        out = io.TextIOWrapper(target)
+        try:
+            yield out
+        finally:
+            # Leave target open for the caller.
+            out.flush()
+            out.detach()
+        return
+    # Compressors need a binary stream underneath them.
+    if not binary:
+        if not hasattr(target, 'buffer'):
+            raise TypeError('Cannot write {} output to {}, which has no underlying binary stream; '
+                            'pass a binary file object or a path instead'.format(compression, target))
+        target.flush()
+        target = target.buffer
+    with CODECS[compression](target, 'wt') as out:
+        yield out
@@ -1,26 +1,56 @@
 from .model import Var, Literal, BooleanLiteral
+from .cache import ExpressionCache
+from .compiler import compile_operands
+from .profiler import Profiler
 from .buffer import *
-from .extractor import generate_extractor
+from .compression import open_output
+from .extractor import Solution, generate_extractor, get_variable_mapping_from_cnf_file, get_vars_set_in_solution
 from .simplify import *
 from .log import logger
+from array import array
+from contextlib import nullcontext
+import itertools
+import subprocess
+import tempfile
 
 # Given one of the various forms of variables/literals, return an integer
 # representation of the underlying literal.
 def raw_lit(expr):
-    if isinstance(expr, Var): return expr.vid
-    elif isinstance(expr, Literal): return expr.sign*expr.var.vid
+    if isinstance(expr, (Var, Literal)): return expr.raw
     elif isinstance(expr, BooleanLiteral): return expr.val
     else: raise ValueError("Expected Var, BooleanLiteral or Literal, got {}".format(expr))
 
+# Raises if any of the integer literals lits is on a variable in eliminated.
+def check_not_eliminated(lits, eliminated):
+    for lit in lits:
+        if abs(lit) in eliminated:
+            raise ValueError('Variable {} was eliminated by Simplify and can no longer be used'.format(abs(lit)))
+
 class Formula:
-    def __init__(self, buffer_class=None, check_variables=True, use_expression_cache=True):
+    # buffer_args are extra keyword arguments for buffer_class, e.g.
+    # {'memory_budget': 2**20} for HybridBuffer.
+    def __init__(self, buffer_class=None, check_variables=True, use_expression_cache=True,
+                 expression_cache_class=None, expression_cache_size=None, profile=False,
+                 buffer_args=None):
         if buffer_class is None:
             buffer_class = MemoryBuffer
+        if buffer_args is None:
+            buffer_args = {}
+        if expression_cache_class is None:
+            expression_cache_class = ExpressionCache
         self.check_variables = check_variables
         self.vars = {}
-        self.buffer = buffer_class()
+        self.buffer = buffer_class(**buffer_args)
         self.nextvar = 1
-        self.expression_cache = {} if use_expression_cache else None
+        self.expression_cache = None
+        if use_expression_cache:
+            self.expression_cache = expression_cache_class(max_size=expression_cache_size)
+        self.profiler = Profiler() if profile else None
+        # Results generated during the current Add, by sid (see compiler.py).
+        self.compiled = None
+        # Variables that Simplify eliminated. Their old constraints are gone,
+        # so new clauses on them would be unsound.
+        self.eliminated_vars = set()
 
     def AddVar(self, name=None):
         if self.vars.get(name) is not None:
@@ -47,28 +77,98 @@ class Formula:
         return tuple(self.AddVar(name.strip()) for name in names)
 
     def AddClause(self, *disjuncts):
-        # Convert any BooleanLiterals to actual bools
-        disjuncts = [(x.val if type(x) == BooleanLiteral else x) for x in  disjuncts]
-        if any(b for b in disjuncts if b is True):
-            return
-        # Otherwise, any other bools are False and we can suppress them.
-        self.buffer.Append(tuple(raw_lit(x) for x in disjuncts if type(x) != bool))
-
-    def Add(self, expr):
-        for clause in expr.generate_cnf(self):
-            self.AddClause(*clause)
-
-    def Analyze(self, expr):
-        old_buffer = self.buffer
-        self.buffer = MemoryBuffer()
-        self.Add(expr)
-        before_count = len(self.buffer.clauses)
-        buffer = simplify(self.buffer)
-        buffer = strengthen_self_subsumed(buffer)
+        lits = []
+        for x in disjuncts:
+            # Vars and Literals carry their integer form, so the common case
+            # is a single attribute lookup.
+            raw = getattr(x, 'raw', None)
+            if raw is not None:
+                lits.append(raw)
+                continue
+            # Convert any BooleanLiterals to actual bools
+            if type(x) == BooleanLiteral: x = x.val
+            if x is True: return
+            # Otherwise, any other bools are False and we can suppress them.
+            if type(x) != bool: lits.append(raw_lit(x))
+        if self.eliminated_vars: check_not_eliminated(lits, self.eliminated_vars)
+        self.buffer.Append(tuple(lits))
+
+    # Adds clauses that are already encoded as DIMACS integer literals,
+    # skipping all per-literal conversion. clauses is either an iterable of
+    # int sequences or, if offsets is given, a flat sequence of literals where
+    # clause i is clauses[offsets[i]:offsets[i+1]]. With validate, checks
+    # that every literal refers to a variable that's already been added.
+    def AddRawClauses(self, clauses, offsets=None, validate=False):
+        if offsets is None:
+            lits, offsets = array('i'), array('q', [0])
+            for clause in clauses:
+                lits.extend(clause)
+                offsets.append(len(lits))
+        else:
+            lits = clauses if isinstance(clauses, array) and clauses.typecode == 'i' else array('i', clauses)
+        if validate:
+            if len(offsets) == 0 or offsets[0] < 0 or offsets[-1] > len(lits) or \
+               any(b < a for a, b in zip(offsets, itertools.islice(offsets, 1, None))):
+                raise ValueError('Invalid clause offsets')
+            region = lits[offsets[0]:offsets[-1]]
+            if 0 in region:
+                raise ValueError('Literal 0 is not allowed in a clause')
+            if len(region) > 0 and max(max(region), -min(region)) >= self.nextvar:
+                raise ValueError('Clause refers to a variable that has not been added')
+        if self.eliminated_vars: check_not_eliminated(lits[offsets[0]:offsets[-1]], self.eliminated_vars)
+        self.buffer.Extend(lits, offsets)
+
+    # label groups this constraint in the profile, if profiling is on.
+    def Add(self, expr, label=None):
+        with self.profiler.Measure(self, expr, label) if self.profiler is not None else nullcontext():
+            # Expressions that add clauses as they're generated call Add
+            # themselves; those nested calls share the outermost one's map.
+            outermost = self.compiled is None
+            if outermost: self.compiled = {}
+            try:
+                compile_operands(expr, self)
+                for clause in expr.generate_cnf(self):
+                    self.AddClause(*clause)
+            finally:
+                if outermost: self.compiled = None
+
+    # Returns the size of the encoding of expr, without adding it to the
+    # formula. By default, the clauses are also simplified to report how
+    # many survive. With dry_run, they're only counted, not stored or
+    # simplified, which is much faster and takes constant memory.
+    def Analyze(self, expr, dry_run=False):
+        # Anything cached while we're analyzing points into the temporary
+        # buffer, so it's dropped along with it, and so are the variables
+        # generated for it. The profile should only reflect what was actually
+        # added, so profiling is off meanwhile.
+        old_buffer, nextvar, profiler = self.buffer, self.nextvar, self.profiler
+        self.buffer = CountingBuffer() if dry_run else MemoryBuffer()
+        self.profiler = None
+        if self.expression_cache is not None: self.expression_cache.PushScope()
+        try:
+            self.Add(expr)
+        finally:
+            new_buffer, self.buffer, self.profiler = self.buffer, old_buffer, profiler
+            if self.expression_cache is not None: self.expression_cache.PopScope()
+            # Generating expressions only adds unnamed variables.
+            new_vars, self.nextvar = self.nextvar - nextvar, nextvar
+            for vid in range(nextvar, nextvar + new_vars):
+                self.vars.pop('_{}'.format(vid), None)
+        if dry_run:
+            stats = new_buffer.Stats()
+            return {
+                'clauses': stats['clauses'],
+                'literals': stats['literals'],
+                'maxvar': stats['maxvar'],
+                'new_vars': new_vars,
+                'lengths': stats['lengths'],
+            }
+        before_count = len(new_buffer.clauses)
+        buffer = simplify(new_buffer)
+        buffer = eliminate_subsumed(buffer)
         buffer = propagate_units(buffer)
         buffer = simplify(buffer)
         after_count = len(buffer.clauses)
-        self.buffer = old_buffer
         return {
             'clauses': before_count,
             'simplified_clauses': after_count,
@@ -77,25 +177,120 @@ class Formula:
 
     def PushCheckpoint(self):
         self.buffer.PushCheckpoint()
+        if self.expression_cache is not None: self.expression_cache.PushScope()
 
     def PopCheckpoint(self):
         self.buffer.PopCheckpoint()
-        if self.expression_cache is not None: self.expression_cache = {}
+        if self.expression_cache is not None: self.expression_cache.PopScope()
+
+    # Writes a report of the clauses, variables, cache hits and time spent per
+    # kind of expression and label passed to Add, as a text table or as JSON
+    # (fmt='json'). Only available with Formula(profile=True).
+    def WriteProfile(self, fd, fmt='text', sort_by='clauses'):
+        if self.profiler is None:
+            raise ValueError('Profiling is off, create the Formula with profile=True')
+        self.profiler.Write(fd, fmt=fmt, sort_by=sort_by)
+
+    # fd can be a file object or a path. Output is compressed with compression
+    # ('gzip', 'bz2' or 'lzma') if given, otherwise paths ending in .gz, .bz2,
+    # .xz or .lzma are compressed with the matching codec. workers > 1 formats
+    # clauses in parallel, for buffers that support it (MemoryBuffer and
+    # ArrayBuffer); other buffers ignore it.
+    def WriteCNF(self, fd, compression=None, workers=None):
+        with open_output(fd, compression) as out:
+            self.buffer.Flush(out, workers=workers)
+
+    # Writes the formula in iCNF format: the clauses under a "p inccnf" header,
+    # followed by one "a ... 0" assumption line per cube, so that an incremental
+    # solver can work through all cubes while keeping what it learns along the
+    # way. Either give vars, a list of variables to split on in all 2^len(vars)
+    # ways, or cubes, a list of cubes that are each a list of literals. fd and
+    # compression are handled as in WriteCNF.
+    def WriteCubedCnf(self, fd, vars=None, cubes=None, compression=None):
+        if (vars is None) == (cubes is None):
+            raise ValueError('WriteCubedCnf needs exactly one of vars or cubes')
+        if vars is not None:
+            vars = [raw_lit(v) for v in vars]
+            cubes = (tuple(sign*v for sign, v in zip(signs, vars))
+                     for signs in itertools.product((1, -1), repeat=len(vars)))
+        else:
+            cubes = (tuple(raw_lit(lit) for lit in cube) for cube in cubes)
+        with open_output(fd, compression) as out:
+            self.buffer.Flush(out, header='p inccnf\n')
+            for cube in cubes:
+                out.write('a {}\n'.format(' '.join(str(lit) for lit in cube + (0,))))
 
-    def WriteCNF(self, fd):
-        self.buffer.Flush(fd)
+    # Runs command, a SAT solver that reads DIMACS CNF on its standard input,
+    # streaming the formula straight into it instead of writing a CNF file
+    # first. The solver should print its result in the usual format ("s ..."
+    # and "v ..." lines). Returns None if the formula is unsatisfiable and
+    # otherwise a Solution mapping the names of variables to their values.
+    # Raises RuntimeError if the solver fails or doesn't decide the formula.
+    def Solve(self, command):
+        with tempfile.TemporaryFile('w+') as output:
+            proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output, text=True)
+            try:
+                self.buffer.Flush(proc.stdin)
+                proc.stdin.close()
+            except BrokenPipeError:
+                # The solver quit early. Its exit code will tell us why.
+                # Closing still flushes what's left in the pipe's buffer,
+                # which fails the same way, but the pipe ends up closed.
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            returncode = proc.wait()
+            # By convention, solvers exit with 10 for SAT and 20 for UNSAT.
+            if returncode not in (0, 10, 20):
+                raise RuntimeError('Solver {} failed with exit code {}'.format(command, returncode))
+            output.seek(0)
+            status = next((line[2:].strip() for line in output if line.startswith('s ')), None)
+            if status == 'UNSATISFIABLE': return None
+            # Solvers that give up (e.g. on a time limit) report UNKNOWN, and
+            # then there's no assignment to read.
+            if status != 'SATISFIABLE':
+                raise RuntimeError('Solver {} did not find a result: {}'.format(
+                    command, 'no "s" line' if status is None else 's ' + status))
+            output.seek(0)
+            solution = get_vars_set_in_solution(output)
+        mapping = get_variable_mapping_from_cnf_file('c {}\n'.format(c) for c in self.buffer.AllComments())
+        return Solution(dict((name, vid in solution) for name, vid in mapping.items()))
 
     def WriteExtractor(self, fd, extractor_fn, extra_fns=None, extra_args=None):
         generate_extractor(fd, extractor_fn, extra_fns, extra_args)
 
-    def Simplify(self):
+    # Optional stages (see simplify.py):
+    #   * probe runs failed literal probing, for at most probe_time_budget
+    #     seconds if given.
+    #   * substitute_equivalences replaces equivalent literals with a single
+    #     representative.
+    #   * eliminate_aux_vars eliminates unnamed variables when that doesn't
+    #     grow the formula.
+    # The last two can remove the clauses defining cached expressions, so they
+    # clear the expression cache. They can also remove unnamed variables from
+    # AddVar() that the caller still holds: adding clauses on any of those
+    # afterwards raises ValueError.
+    def Simplify(self, eliminate_aux_vars=False, substitute_equivalences=False, probe=False,
+                 probe_time_budget=None):
         log = logger()
         log.info('Running basic simplifications...')
         self.buffer = simplify(self.buffer)
-        log.info('Strengthening self-subsumed...')
-        self.buffer = strengthen_self_subsumed(self.buffer)
+        log.info('Eliminating subsumed clauses...')
+        self.buffer = eliminate_subsumed(self.buffer)
         log.info('Propagating units...')
         self.buffer = propagate_units(self.buffer)
+        if probe:
+            log.info('Probing failed literals...')
+            self.buffer = probe_failed_literals(self.buffer, time_budget=probe_time_budget)
+        if substitute_equivalences:
+            log.info('Substituting equivalent literals...')
+            self.buffer = substitute_equivalent_literals(self.buffer, eliminated=self.eliminated_vars)
+        if eliminate_aux_vars:
+            log.info('Eliminating auxiliary variables...')
+            self.buffer = eliminate_variables(self.buffer, eliminated=self.eliminated_vars)
+        if (substitute_equivalences or eliminate_aux_vars) and self.expression_cache is not None:
+            self.expression_cache.Clear()
         log.info('Running basic simplifications again...')
         self.buffer = simplify(self.buffer)
         log.info('Done simplifying.')
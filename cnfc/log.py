@@ -1,10 +1,13 @@
 import logging
 
 def logger(level=logging.DEBUG):
-    formatter = logging.Formatter(fmt='%(asctime)s [%(module)s] %(message)s')
-    handler = logging.StreamHandler()
-    handler.setFormatter(formatter)
     logger = logging.getLogger(__name__)
     logger.setLevel(level)
-    logger.addHandler(handler)
+    # Only set up the handler once, otherwise every call to logger() would
+    # print each message one more time.
+    if not logger.handlers:
+        formatter = logging.Formatter(fmt='%(asctime)s [%(module)s] %(message)s')
+        handler = logging.StreamHandler()
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
     return logger
@@ -7,8 +7,8 @@ from .tseytin import gen_and, gen_or, gen_eq, gen_neq
 from .bool_lit import BooleanLiteral, lpad
 from .tuples import tuple_less_than, tuple_add, tuple_mul, tuple_min, tuple_max
 from .regex import regex_match
-from .util import Generator, gather_common_operands, reduce_evaluated
-from .cache import cached_generate_var
+from .util import Generator, gather_common_operands, unique_operands, reduce_evaluated
+from .cache import Interned, cached_generate_var, cached_evaluate, key_of
 
 # A generic way to implement generate_var from a generate_cnf implementation.
 # Not always the most efficient, but a good fallback.
@@ -25,6 +25,9 @@ def generate_var_from_cnf(instance, formula):
     return And(*vars_to_and).generate_var(formula)
 
 class BoolExpr:
+    # Lets Var and Literal do without a __dict__.
+    __slots__ = ()
+
     def __eq__(self, other):
         return Eq(self, other)
 
@@ -59,15 +62,33 @@ class NumExpr:
     def __ge__(self, other):
         return NumGe(self, other)
 
+# Literals are created by the hundreds of millions during encoding, so they're
+# slotted and each Var hands out the same two Literal objects instead of
+# allocating new ones on every negation.
 class Literal(BoolExpr):
+    __slots__ = ('var', 'sign', 'raw')
+
     def __init__(self, var, sign):
         self.var, self.sign = var, sign
+        # The DIMACS form of this literal.
+        self.raw = sign*var.vid
+
+    def __int__(self):
+        return self.raw
 
     def __repr__(self):
         return 'Literal({},{})'.format(self.var, self.sign)
 
+    @property
+    def sid(self):
+        return 2*self.var.vid + (self.sign < 0)
+
+    @property
+    def key(self):
+        return (self.sid, self.var.name)
+
     def __invert__(self):
-        return Literal(self.var, sign=-self.sign)
+        return self.var.positive() if self.sign < 0 else self.var.negative()
 
     def generate_var(self, formula):
         return self
@@ -76,33 +97,77 @@ class Literal(BoolExpr):
         yield (self,)
 
 class Var(BoolExpr):
+    __slots__ = ('name', 'vid', 'raw', 'pos', 'neg')
+
     def __init__(self, name, vid):
         self.name = name
         self.vid = vid
+        # The DIMACS form of the positive literal of this variable.
+        self.raw = vid
+        self.pos, self.neg = None, None
+
+    def __int__(self):
+        return self.raw
 
     def __repr__(self):
         return 'Var({},{})'.format(self.name, self.vid)
 
+    # Same as the sid of the positive literal of this variable.
+    @property
+    def sid(self):
+        return 2*self.vid
+
+    @property
+    def key(self):
+        return (self.sid, self.name)
+
+    def positive(self):
+        if self.pos is None: self.pos = Literal(self, sign=1)
+        return self.pos
+
+    def negative(self):
+        if self.neg is None: self.neg = Literal(self, sign=-1)
+        return self.neg
+
     def __invert__(self):
-        return Literal(self, sign=-1)
+        return self.negative()
 
     def generate_var(self, formula):
-        return Literal(self, sign=1)
+        return self.positive()
 
     def generate_cnf(self, formula):
         yield (self,)
 
-class MultiBoolExpr(BoolExpr):
+# And and Or are associative, commutative and idempotent: nested operands of
+# the same class are flattened into this one and duplicates are dropped.
+class MultiBoolExpr(BoolExpr, Interned):
+    commutative = True
+    idempotent = True
+
     def __init__(self, *exprs):
-        self.exprs = exprs
+        flat = []
+        for expr in exprs:
+            if expr.__class__ is self.__class__: flat.extend(expr.exprs)
+            else: flat.append(expr)
+        self.exprs = tuple(unique_operands(flat))
+
+    def _operands(self):
+        if has_complementary_operands(self.exprs): return []
+        return super()._operands()
+
+    def _structure(self):
+        return self.exprs
 
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, ','.join(repr(expr) for expr in self.exprs))
 
-class Not(BoolExpr):
+class Not(BoolExpr, Interned):
     def __init__(self, expr):
         self.expr = expr
 
+    def _structure(self):
+        return (self.expr,)
+
     def __repr__(self):
         return 'Not({})'.format(self.expr)
 
@@ -113,10 +178,13 @@ class Not(BoolExpr):
     def generate_cnf(self, formula):
         yield (~self.expr.generate_var(formula),)
 
-class BooleanTernaryExpr(BoolExpr):
+class BooleanTernaryExpr(BoolExpr, Interned):
     def __init__(self, cond, if_true, if_false):
         self.cond, self.if_true, self.if_false = cond, if_true, if_false
 
+    def _structure(self):
+        return (self.cond, self.if_true, self.if_false)
+
     def __repr__(self):
         return 'BooleanTernaryExpr({}, {}, {})'.format(self.cond, self.if_true, self.if_false)
 
@@ -127,10 +195,13 @@ class BooleanTernaryExpr(BoolExpr):
     def generate_cnf(self, formula):
         yield from Or(And(self.cond, self.if_true), And(~self.cond, self.if_false)).generate_cnf(formula)
 
-class OrderedBinaryBoolExpr(BoolExpr):
+class OrderedBinaryBoolExpr(BoolExpr, Interned):
     def __init__(self, first, second):
         self.first, self.second = first, second
 
+    def _structure(self):
+        return (self.first, self.second)
+
     def __repr__(self):
         return '{}({},{})'.format(self.__class__.__name__, self.first, self.second)
 
@@ -147,6 +218,8 @@ class Implies(OrderedBinaryBoolExpr):
 class And(MultiBoolExpr):
     @cached_generate_var
     def generate_var(self, formula):
+        if has_complementary_operands(self.exprs):
+            return BooleanLiteral(False)
         v = formula.AddVar()
         subvars = [expr.generate_var(formula) for expr in self.exprs]
         for clause in gen_and(subvars, v):
@@ -154,12 +227,17 @@ class And(MultiBoolExpr):
         return v
 
     def generate_cnf(self, formula):
+        if has_complementary_operands(self.exprs):
+            yield ()
+            return
         for expr in self.exprs:
             yield (expr.generate_var(formula),)
 
 class Or(MultiBoolExpr):
     @cached_generate_var
     def generate_var(self, formula):
+        if has_complementary_operands(self.exprs):
+            return BooleanLiteral(True)
         v = formula.AddVar()
         subvars = [expr.generate_var(formula) for expr in self.exprs]
         for clause in gen_or(subvars, v):
@@ -167,11 +245,22 @@ class Or(MultiBoolExpr):
         return v
 
     def generate_cnf(self, formula):
+        if has_complementary_operands(self.exprs):
+            return
         yield tuple(expr.generate_var(formula) for expr in self.exprs)
 
 class Eq(OrderedBinaryBoolExpr):
+    commutative = True
+
+    def _operands(self):
+        if operand_relation(self.first, self.second) is not None: return []
+        return super()._operands()
+
     @cached_generate_var
     def generate_var(self, formula):
+        relation = operand_relation(self.first, self.second)
+        if relation is not None:
+            return BooleanLiteral(relation)
         v = formula.AddVar()
         fv = self.first.generate_var(formula)
         sv = self.second.generate_var(formula)
@@ -180,14 +269,27 @@ class Eq(OrderedBinaryBoolExpr):
         return v
 
     def generate_cnf(self, formula):
+        relation = operand_relation(self.first, self.second)
+        if relation is not None:
+            if not relation: yield ()
+            return
         fv = self.first.generate_var(formula)
         sv = self.second.generate_var(formula)
         yield (~fv, sv)
         yield (~sv, fv)
 
 class Neq(OrderedBinaryBoolExpr):
+    commutative = True
+
+    def _operands(self):
+        if operand_relation(self.first, self.second) is not None: return []
+        return super()._operands()
+
     @cached_generate_var
     def generate_var(self, formula):
+        relation = operand_relation(self.first, self.second)
+        if relation is not None:
+            return BooleanLiteral(not relation)
         v = formula.AddVar()
         fv = self.first.generate_var(formula)
         sv = self.second.generate_var(formula)
@@ -196,12 +298,16 @@ class Neq(OrderedBinaryBoolExpr):
         return v
 
     def generate_cnf(self, formula):
+        relation = operand_relation(self.first, self.second)
+        if relation is not None:
+            if relation: yield ()
+            return
         fv = self.first.generate_var(formula)
         sv = self.second.generate_var(formula)
         yield (fv, sv)
         yield (~fv, ~sv)
 
-class OrderedBinaryTupleBoolExpr(BoolExpr):
+class OrderedBinaryTupleBoolExpr(BoolExpr, Interned):
     def __init__(self, first, second):
         self.first, self.second = first, second
         if isinstance(self.first, int):
@@ -209,6 +315,9 @@ class OrderedBinaryTupleBoolExpr(BoolExpr):
         if isinstance(self.second, int):
             self.second = Integer(self.second)
 
+    def _structure(self):
+        return (self.first, self.second)
+
     def __repr__(self):
         return '{}({},{})'.format(self.__class__.__name__, self.first, self.second)
 
@@ -336,12 +445,15 @@ class TupleExpr:
         return TuplePow(other, self, modulo)
 
 # An expression combining two Tuples (addition, multiplication) that results in a Tuple
-class TupleCompositeExpr(TupleExpr, ABC):
+class TupleCompositeExpr(TupleExpr, Interned, ABC):
     def __init__(self, *args):
         self.args = [Integer(arg) if isinstance(arg, int) else arg for arg in args]
         # TODO: dummy exprs to make asserts work, fix later when we don't do these asserts any more
         self.exprs = [None]*(len(self.args[0]))
 
+    def _structure(self):
+        return tuple(self.args)
+
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, ','.join(map(str, self.args)))
 
@@ -353,10 +465,13 @@ class TupleCompositeExpr(TupleExpr, ABC):
         pass
 
 class TupleAdd(TupleCompositeExpr):
+    commutative = True
+
     def __init__(self, *args):
         super().__init__(*args)
         self.args = gather_common_operands(self.__class__, self.args)
 
+    @cached_evaluate
     def evaluate(self, formula):
         return reduce_evaluated(tuple_add, [arg.evaluate(formula) for arg in self.args], formula)
 
@@ -364,10 +479,13 @@ class TupleAdd(TupleCompositeExpr):
         return max(len(arg) for arg in self.args) + int(math.ceil(math.log2(len(self.args)))) + 1
 
 class TupleMul(TupleCompositeExpr):
+    commutative = True
+
     def __init__(self, *args):
         super().__init__(*args)
         self.args = gather_common_operands(self.__class__, self.args)
 
+    @cached_evaluate
     def evaluate(self, formula):
         return reduce_evaluated(tuple_mul, [arg.evaluate(formula) for arg in self.args], formula)
 
@@ -375,10 +493,14 @@ class TupleMul(TupleCompositeExpr):
         return sum(len(arg) for arg in self.args)
 
 class TupleMax(TupleCompositeExpr):
+    commutative = True
+    idempotent = True
+
     def __init__(self, *args):
         super().__init__(*args)
-        self.args = gather_common_operands(self.__class__, self.args)
+        self.args = unique_operands(gather_common_operands(self.__class__, self.args))
 
+    @cached_evaluate
     def evaluate(self, formula):
         return reduce_evaluated(tuple_max, [arg.evaluate(formula) for arg in self.args], formula)
 
@@ -386,10 +508,14 @@ class TupleMax(TupleCompositeExpr):
         return max(len(arg) for arg in self.args)
 
 class TupleMin(TupleCompositeExpr):
+    commutative = True
+    idempotent = True
+
     def __init__(self, *args):
         super().__init__(*args)
-        self.args = gather_common_operands(self.__class__, self.args)
+        self.args = unique_operands(gather_common_operands(self.__class__, self.args))
 
+    @cached_evaluate
     def evaluate(self, formula):
         return reduce_evaluated(tuple_min, [arg.evaluate(formula) for arg in self.args], formula)
 
@@ -399,6 +525,7 @@ class TupleMin(TupleCompositeExpr):
         return max(len(arg) for arg in self.args)
 
 class TupleSub(TupleCompositeExpr):
+    @cached_evaluate
     def evaluate(self, formula):
         t1, t2 = self.args
         # if t1 - t2 == y, then t2 + y == t1
@@ -411,6 +538,7 @@ class TupleSub(TupleCompositeExpr):
         return max(len(self.args[0]), len(self.args[1]))
 
 class TupleDiv(TupleCompositeExpr):
+    @cached_evaluate
     def evaluate(self, formula):
         t1, t2 = self.args
         # if t1 // t2 == x, then t2 * x + y == t1, where 0 <= y < t2
@@ -426,6 +554,13 @@ class TupleDiv(TupleCompositeExpr):
         return len(self.args[0])
 
 class TupleMod(TupleCompositeExpr):
+    def _operands(self):
+        t1, t2 = self.args
+        if isinstance(t1, TuplePow) and t1.args[2] is None:
+            return [t1.args[0], t1.args[1], t2]
+        return super()._operands()
+
+    @cached_evaluate
     def evaluate(self, formula):
         t1, t2 = self.args
         # Optimization: Turn '(x ** y) % n' into pow(x,y,n)
@@ -444,6 +579,7 @@ class TupleMod(TupleCompositeExpr):
         return len(self.args[1])
 
 class TuplePow(TupleCompositeExpr):
+    @cached_evaluate
     def evaluate(self, formula):
         base, power, mod = self.args
         base = base.evaluate(formula)
@@ -467,12 +603,15 @@ class TuplePow(TupleCompositeExpr):
             return int(math.floor(len(power) * math.log2(len(base))) + 1)
         return len(mod)
 
-class Tuple(TupleExpr):
+class Tuple(TupleExpr, Interned):
     def __init__(self, *exprs):
         self.exprs = exprs
         for expr in self.exprs:
             assert issubclass(type(expr), (BoolExpr, BooleanLiteral)), "{} needs boolean expressions, got {}".format(self.__class__.__name__, expr)
 
+    def _structure(self):
+        return tuple(self.exprs)
+
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, ','.join(repr(e) for e in self.exprs))
 
@@ -495,11 +634,14 @@ class Integer(Tuple):
         else:
             self.exprs = values
 
-class RegexMatch(BoolExpr):
+class RegexMatch(BoolExpr, Interned):
     def __init__(self, tup: 'TupleExpr', regex):
         self.tuple = tup
         self.regex = regex
 
+    def _structure(self):
+        return (self.tuple, self.regex)
+
     @cached_generate_var
     def generate_var(self, formula):
         return generate_var_from_cnf(self, formula)
@@ -514,9 +656,13 @@ class TupleTernaryExpr(Tuple):
     def __repr__(self):
         return '{}({},{},{})'.format(self.__class__.__name__, self.cond, self.if_true, self.if_false)
 
+    def _structure(self):
+        return (self.cond, self.if_true, self.if_false)
+
     def __len__(self):
         return max(len(self.if_true), len(self.if_false))
 
+    @cached_evaluate
     def evaluate(self, formula):
         t1 = self.if_true.evaluate(formula)
         t2 = self.if_false.evaluate(formula)
@@ -524,14 +670,18 @@ class TupleTernaryExpr(Tuple):
         t2 = lpad(t2, len(t1) - len(t2))
         return [Or(And(self.cond, t1[i]), And(~self.cond, t2[i])).generate_var(formula) for i in range(len(t1))]
 
-class CardinalityConstraint(NumExpr):
+class CardinalityConstraint(NumExpr, Interned):
     def __init__(self, *exprs):
         self.exprs = exprs
 
+    def _structure(self):
+        return self.exprs
+
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, ','.join(repr(e) for e in self.exprs))
 
 class NumTrue(CardinalityConstraint, TupleExpr):
+    @cached_evaluate
     def evaluate(self, formula):
         if len(self.exprs) == 0:
             return Integer(0)
@@ -539,13 +689,22 @@ class NumTrue(CardinalityConstraint, TupleExpr):
         return reduce_evaluated(tuple_add, indicators, formula)
 
 class NumFalse(CardinalityConstraint, TupleExpr):
+    @cached_evaluate
     def evaluate(self, formula):
         if len(self.exprs) == 0:
             return Integer(0)
         indicators = [If(v, Integer(0), Integer(1)).evaluate(formula) for v in self.exprs]
         return reduce_evaluated(tuple_add, indicators, formula)
 
-class NumEq(OrderedBinaryBoolExpr):
+# Comparisons of a NumTrue or NumFalse with an int use cardinality encodings on
+# the counted expressions directly, the count itself is never evaluated.
+class CardinalityComparison(OrderedBinaryBoolExpr):
+    def _operands(self):
+        if type(self.second) is int:
+            return [x for x in self.first.exprs if isinstance(x, Interned)]
+        return super()._operands()
+
+class NumEq(CardinalityComparison):
     @cached_generate_var
     def generate_var(self, formula):
         return generate_var_from_cnf(self, formula)
@@ -563,7 +722,7 @@ class NumEq(OrderedBinaryBoolExpr):
             raise ValueError("Only NumTrue and NumFalse are supported.")
         yield from exactly_n_true(formula, vars, n)
 
-class NumNeq(OrderedBinaryBoolExpr):
+class NumNeq(CardinalityComparison):
     @cached_generate_var
     def generate_var(self, formula):
         return generate_var_from_cnf(self, formula)
@@ -581,7 +740,7 @@ class NumNeq(OrderedBinaryBoolExpr):
             raise ValueError("Only NumTrue and NumFalse are supported.")
         yield from not_exactly_n_true(formula, vars, n)
 
-class NumLt(OrderedBinaryBoolExpr):
+class NumLt(CardinalityComparison):
     @cached_generate_var
     def generate_var(self, formula):
         return generate_var_from_cnf(self, formula)
@@ -598,7 +757,7 @@ class NumLt(OrderedBinaryBoolExpr):
         else:
             raise ValueError("Only NumTrue and NumFalse are supported.")
 
-class NumLe(OrderedBinaryBoolExpr):
+class NumLe(CardinalityComparison):
     @cached_generate_var
     def generate_var(self, formula):
         return generate_var_from_cnf(self, formula)
@@ -615,7 +774,7 @@ class NumLe(OrderedBinaryBoolExpr):
         else:
             raise ValueError("Only NumTrue and NumFalse are supported.")
 
-class NumGt(OrderedBinaryBoolExpr):
+class NumGt(CardinalityComparison):
     @cached_generate_var
     def generate_var(self, formula):
         return generate_var_from_cnf(self, formula)
@@ -632,7 +791,7 @@ class NumGt(OrderedBinaryBoolExpr):
         else:
             raise ValueError("Only NumTrue and NumFalse are supported.")
 
-class NumGe(OrderedBinaryBoolExpr):
+class NumGe(CardinalityComparison):
     @cached_generate_var
     def generate_var(self, formula):
         return generate_var_from_cnf(self, formula)
@@ -662,5 +821,20 @@ def If(arg1, arg2, arg3=None):
             return BooleanTernaryExpr(arg1, arg2, arg3)
     raise ValueError("Unsupported form of If.")
 
-# TODO: implement canonical_form method for all Exprs so we can cache them correctly.
-#       for now, we just cache based on repr
+# Returns the key of the negation of expr, if we can tell it without
+# generating anything, otherwise None.
+def negated_key(expr):
+    if isinstance(expr, Not): return key_of(expr.expr)
+    if isinstance(expr, (Var, Literal, BooleanLiteral)): return key_of(~expr)
+    return None
+
+def has_complementary_operands(exprs):
+    keys = set(key_of(expr) for expr in exprs)
+    return any(negated_key(expr) in keys for expr in exprs)
+
+# Returns True if two boolean expressions are known to be equal, False if one
+# is known to be the negation of the other and None if we can't tell.
+def operand_relation(first, second):
+    if key_of(first) == key_of(second): return True
+    if negated_key(first) == key_of(second) or negated_key(second) == key_of(first): return False
+    return None
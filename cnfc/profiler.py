@@ -0,0 +1,76 @@
+# Per-constraint profiling for Formula.Add.
+#
+# With Formula(profile=True), every top-level call to Formula.Add records the
+# wall time it took, the clauses and auxiliary variables it produced and the
+# expression cache hits it got, grouped by the class of the added expression
+# and an optional user-supplied label. Adds made while generating another
+# expression (e.g., the constraints behind integer division) count towards
+# the outer one.
+from contextlib import contextmanager
+import json
+import time
+
+class ProfileEntry:
+    def __init__(self, expression, label):
+        self.expression = expression
+        self.label = label
+        self.adds = 0
+        self.clauses = 0
+        self.vars = 0
+        self.cache_hits = 0
+        self.seconds = 0.0
+
+    def AsDict(self):
+        return {'expression': self.expression, 'label': self.label, 'adds': self.adds,
+                'clauses': self.clauses, 'vars': self.vars, 'cache_hits': self.cache_hits,
+                'seconds': self.seconds}
+
+def cache_hits(formula):
+    return 0 if formula.expression_cache is None else formula.expression_cache.hits
+
+class Profiler:
+    def __init__(self):
+        self.entries = {}
+        self.depth = 0
+
+    @contextmanager
+    def Measure(self, formula, expr, label=None):
+        self.depth += 1
+        try:
+            if self.depth > 1:
+                yield
+                return
+            start = (time.perf_counter(), formula.buffer.num_clauses, formula.nextvar, cache_hits(formula))
+            yield
+            seconds, clauses, nextvar, hits = start
+            key = (expr.__class__.__name__, label)
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = ProfileEntry(*key)
+            entry.adds += 1
+            entry.clauses += formula.buffer.num_clauses - clauses
+            entry.vars += formula.nextvar - nextvar
+            entry.cache_hits += cache_hits(formula) - hits
+            entry.seconds += time.perf_counter() - seconds
+        finally:
+            self.depth -= 1
+
+    # Entries sorted by the given field, largest first.
+    def Report(self, sort_by='clauses'):
+        return sorted(self.entries.values(), key=lambda e: getattr(e, sort_by), reverse=True)
+
+    def Write(self, fd, fmt='text', sort_by='clauses'):
+        entries = self.Report(sort_by)
+        if fmt == 'json':
+            json.dump([entry.AsDict() for entry in entries], fd, indent=2)
+            fd.write('\n')
+        elif fmt == 'text':
+            header = ('expression', 'label', 'adds', 'clauses', 'vars', 'cache hits', 'seconds')
+            rows = [(e.expression, '' if e.label is None else str(e.label), str(e.adds), str(e.clauses),
+                     str(e.vars), str(e.cache_hits), '{:.3f}'.format(e.seconds)) for e in entries]
+            widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+            for row in [header] + rows:
+                cols = [col.ljust(w) if i < 2 else col.rjust(w) for i, (col, w) in enumerate(zip(row, widths))]
+                fd.write('  '.join(cols).rstrip() + '\n')
+        else:
+            raise ValueError('Unknown profile format: {}'.format(fmt))
@@ -4,10 +4,22 @@
 # and we never remove variables. In practice, the "never remove variables"
 # condition just means that we don't reset the max variable in the DIMACS CNF
 # file header, even though the variable may no longer appear in any clauses.
+#
+# The exceptions are eliminate_variables and substitute_equivalent_literals,
+# which remove auxiliary variables. Extractors only look at variables named in
+# "var N : name" comments, and any solution of the result can be extended to
+# one of the original formula on the same named variables, so extraction still
+# works.
 
 from .buffer import *
-from collections import defaultdict
+from .log import logger
+from array import array
+from collections import defaultdict, deque
 from functools import reduce
+from itertools import islice
+import re
+import time
+import warnings
 
 # Do any easy simplifications in two passes. This includes:
 # (1) eliminating tautologies
@@ -22,7 +34,7 @@ def simplify(b):
         bits = [1 << hashlit(lit) for lit in clause]
         return reduce(lambda x,y: x | y, bits, 0)
 
-    new_b = b.__class__(maxvar=b.maxvar)
+    new_b = b.Empty()
     signs = defaultdict(set)  # Maps var to lits seen
     sigs = set()
     possible_dups = set()
@@ -46,7 +58,7 @@ def simplify(b):
     pure_lits = set(next(iter(lits)) for (v, lits) in signs.items() if len(lits) == 1)
 
     # One final pass to remove pure literals and duplicate clauses
-    final_b = b.__class__(maxvar=b.maxvar)
+    final_b = b.Empty()
     for comment in b.AllComments():
         final_b.AddComment(comment)
     seen = {}
@@ -64,86 +76,422 @@ def simplify(b):
 
     return final_b
 
+# Unit propagation with two watched literals per clause. Each clause of two or
+# more literals watches its first two; a clause is only visited when one of
+# its watched literals becomes false, and then it either finds another
+# literal to watch or becomes unit (or conflicting). Every assigned literal
+# goes on the trail, so Backtrack can undo assignments made after a Mark,
+# which is what failed literal probing needs. Reaching the fixpoint takes time
+# linear in the size of the formula.
+class Propagator:
+    # Clauses are stored ArrayBuffer-style, as a flat array of literals plus
+    # offsets, so that propagating a FileBuffer doesn't pull the whole formula
+    # into memory as Python objects. The watched literals of clause ci are
+    # lits[offsets[ci]] and lits[offsets[ci]+1].
+    def __init__(self, clauses, maxvar=0):
+        self.lits, self.offsets = array('i'), array('q', [0])
+        for clause in clauses:
+            self.lits.extend(clause)
+            self.offsets.append(len(self.lits))
+        maxvar = max(maxvar, max_var(self.lits))
+        # vals[v] is 1 if v is true, -1 if it's false and 0 if unassigned.
+        self.vals = array('b', bytes(maxvar + 1))
+        self.watches = defaultdict(list)
+        self.trail = []
+        self.head = 0  # Trail entries before head have been propagated.
+        self.conflict = False
+        lits, offsets = self.lits, self.offsets
+        for ci in range(len(offsets) - 1):
+            start, end = offsets[ci], offsets[ci+1]
+            if end == start:
+                self.conflict = True
+            elif end == start + 1:
+                self.Assign(lits[start])
+            else:
+                self.watches[lits[start]].append(ci)
+                self.watches[lits[start+1]].append(ci)
+
+    # Iterates over the clauses, as slices of lits.
+    def Clauses(self):
+        lits, offsets = self.lits, self.offsets
+        for start, end in zip(offsets, islice(offsets, 1, len(offsets))):
+            yield lits[start:end]
+
+    def Value(self, lit):
+        val = self.vals[abs(lit)]
+        return val if lit > 0 else -val
+
+    # Makes lit true. Returns False (and records a conflict) if it's false.
+    def Assign(self, lit):
+        val = self.Value(lit)
+        if val == -1:
+            self.conflict = True
+            return False
+        if val == 0:
+            self.vals[abs(lit)] = 1 if lit > 0 else -1
+            self.trail.append(lit)
+        return True
+
+    # Propagates everything on the trail. Returns False on a conflict.
+    def Propagate(self):
+        lits, offsets, vals, watches, trail = self.lits, self.offsets, self.vals, self.watches, self.trail
+        while not self.conflict and self.head < len(trail):
+            false_lit = -trail[self.head]
+            self.head += 1
+            watching = watches[false_lit]
+            kept = []
+            for i, ci in enumerate(watching):
+                start, end = offsets[ci], offsets[ci+1]
+                # Keep the false literal in the second watched position.
+                if lits[start] == false_lit:
+                    lits[start], lits[start+1] = lits[start+1], false_lit
+                first = lits[start]
+                if (vals[first] if first > 0 else -vals[-first]) == 1:
+                    kept.append(ci)
+                    continue
+                for k in range(start + 2, end):
+                    lit = lits[k]
+                    if (vals[lit] if lit > 0 else -vals[-lit]) != -1:
+                        lits[start+1], lits[k] = lit, false_lit
+                        watches[lit].append(ci)
+                        break
+                else:
+                    kept.append(ci)
+                    if not self.Assign(first):
+                        kept.extend(watching[i+1:])
+                        break
+            watches[false_lit] = kept
+        return not self.conflict
+
+    def Mark(self):
+        return len(self.trail)
+
+    # Undoes every assignment made since the given Mark.
+    def Backtrack(self, mark):
+        for lit in self.trail[mark:]:
+            self.vals[abs(lit)] = 0
+        del self.trail[mark:]
+        self.head = min(self.head, mark)
+        self.conflict = False
+
+    # Writes the formula with everything on the trail applied to new_b: the
+    # assigned literals as units, then every clause that isn't satisfied yet
+    # with its false literals removed. On a conflict, that's just the empty
+    # clause.
+    def Apply(self, new_b):
+        if self.conflict:
+            new_b.Append(())
+            return new_b
+        for lit in self.trail:
+            new_b.Append((lit,))
+        for clause in self.Clauses():
+            values = [self.Value(lit) for lit in clause]
+            if 1 in values: continue
+            new_b.Append(tuple(lit for lit, val in zip(clause, values) if val == 0))
+        return new_b
+
+def copy_comments(b):
+    new_b = b.Empty()
+    for comment in b.AllComments():
+        new_b.AddComment(comment)
+    return new_b
+
+# max_iterations is deprecated and ignored: propagation reaches the fixpoint
+# in a single pass.
 def propagate_units(b, max_iterations=None):
-    if max_iterations is None:
-        max_iterations = 2**10
-    iterations = 0
-    prev_unit_count = -1
-    units = set()
-
-    while len(units) > prev_unit_count:
-        prev_unit_count = len(units)
-        new_b = b.__class__(maxvar=b.maxvar)
-        for comment in b.AllComments():
-            new_b.AddComment(comment)
-        for clause in b.AllClauses():
-            if len(clause) > 1 and any(lit for lit in clause if lit in units):
+    if max_iterations is not None:
+        warnings.warn('propagate_units no longer takes max_iterations, it always runs '
+                      'to the fixpoint', DeprecationWarning, stacklevel=2)
+    propagator = Propagator(b.AllClauses(), b.maxvar)
+    if not propagator.Propagate():
+        logger().warning('Unit propagation found a conflict: the formula is unsatisfiable.')
+    return propagator.Apply(copy_comments(b))
+
+# A 64-bit summary of the variables in a clause. If clause c subsumes clause d
+# (possibly after flipping one literal), every variable of c is in d, so
+# sig(c) & ~sig(d) == 0. That rules out most candidate pairs without looking at
+# their literals.
+def var_signature(clause):
+    sig = 0
+    for lit in clause:
+        sig |= 1 << (abs(lit) & 63)
+    return sig
+
+# Subsumption and self-subsuming strengthening. If clause c is a subset of
+# clause d, d is redundant and is deleted. If c is a subset of d except for one
+# literal l, where d contains -l instead, resolving the two on l gives d
+# without -l, so -l can be removed from d.
+#
+# Every clause goes through a work queue once and is checked against the
+# clauses in the occurrence lists of its least frequent variable. Clauses that
+# get strengthened shrink and might subsume others now, so they go back on the
+# queue.
+def eliminate_subsumed(b, delete=True):
+    clauses = []
+    for clause in b.AllClauses():
+        # A tautology would let c "subsume" d on just one of its two
+        # complementary literals, so drop them up front.
+        lits = set(clause)
+        if any(-lit in lits for lit in lits): continue
+        clauses.append(list(dict.fromkeys(clause)))
+    litsets = [set(clause) for clause in clauses]
+    sigs = [var_signature(clause) for clause in clauses]
+    alive = [True] * len(clauses)
+    occur = defaultdict(set)
+    for i, clause in enumerate(clauses):
+        for lit in clause:
+            occur[lit].add(i)
+
+    # Returns (True, None) if c is a subset of d, (True, l) if c is a subset of
+    # d except for l, where -l is in d, and (False, None) otherwise.
+    def subsumes(c, d):
+        flipped = None
+        for lit in c:
+            if lit in d: continue
+            if flipped is None and -lit in d:
+                flipped = lit
                 continue
-            new_clause = tuple(lit for lit in clause if -lit not in units)
-            if len(new_clause) == 1:
-                units.add(new_clause[0])
-            new_b.Append(new_clause)
-        b = new_b
-        iterations += 1
-        if iterations >= max_iterations:
-            break
-    return b
+            return False, None
+        return True, flipped
+
+    queue = deque(sorted(range(len(clauses)), key=lambda i: len(clauses[i])))
+    queued = [True] * len(clauses)
+    while queue:
+        ci = queue.popleft()
+        queued[ci] = False
+        if not alive[ci] or len(clauses[ci]) == 0: continue
+        c, csig = litsets[ci], sigs[ci]
+        best = min(clauses[ci], key=lambda lit: len(occur[lit]) + len(occur[-lit]))
+        for di in list(occur[best]) + list(occur[-best]):
+            if di == ci or not alive[di] or len(clauses[di]) < len(c): continue
+            if csig & ~sigs[di]: continue
+            ok, flipped = subsumes(c, litsets[di])
+            if not ok: continue
+            if flipped is None:
+                if not delete: continue
+                alive[di] = False
+                for lit in clauses[di]:
+                    occur[lit].discard(di)
+            else:
+                clauses[di].remove(-flipped)
+                litsets[di].discard(-flipped)
+                occur[-flipped].discard(di)
+                sigs[di] = var_signature(clauses[di])
+                if not queued[di]:
+                    queued[di] = True
+                    queue.append(di)
 
+    new_b = copy_comments(b)
+    for clause, live in zip(clauses, alive):
+        if live: new_b.Append(tuple(clause))
+    return new_b
+
+# Only strengthens clauses, without deleting any.
 def strengthen_self_subsumed(b):
-    # Map literals to a list of clause indices where they occur.
-    occur = defaultdict(list)
+    return eliminate_subsumed(b, delete=False)
+
+# Returns the set of variables named in comments of the form "var N : name".
+def named_variables(b):
+    p = re.compile(r'var (\d+) : ')
+    return set(int(m.group(1)) for m in (p.match(comment) for comment in b.AllComments()) if m)
+
+# Bounded variable elimination, as in SatELite, restricted to unnamed
+# variables. Eliminating v replaces all clauses containing v or -v with all
+# non-tautological resolvents on v. We only do that when there are at most as
+# many resolvents as clauses they replace, none of them longer than
+# max_resolvent_size, and skip variables occurring more than max_occurrences
+# times in either polarity, since those rarely pass and are expensive to try.
+# If eliminated is given, the eliminated variables are added to that set.
+def eliminate_variables(b, max_occurrences=16, max_resolvent_size=16, eliminated=None):
+    named = named_variables(b)
     clauses = []
     for clause in b.AllClauses():
-        clauses.append(clause)
+        lits = set(clause)
+        if any(-lit in lits for lit in lits): continue  # Drop tautologies
+        clauses.append(tuple(dict.fromkeys(clause)))
+    alive = [True] * len(clauses)
+    occur = defaultdict(set)
+    for i, clause in enumerate(clauses):
         for lit in clause:
-            occur[lit].append(len(clauses)-1)
+            occur[lit].add(i)
 
-    # Is c1 a strict subset of c2?
-    def subset(c1, c2):
-        if len(c1) >= len(c2): return False
-        for lit in c1:
-            if lit not in c2: return False
-        return True
+    # Resolves p and n on v, returning None if the result is a tautology.
+    def resolve(p, n, v):
+        lits = dict.fromkeys(lit for lit in p if lit != v)
+        for lit in n:
+            if lit == -v: continue
+            if -lit in lits: return None
+            lits[lit] = None
+        return tuple(lits)
 
-    # Find clauses that are subsumed by the given clause.
-    def find_subsumed(clause):
-        # l is the lit in clause with the shortest occur list.
-        l = clause[0]
-        for lit in clause[1:]:
-            if len(occur[lit]) < len(occur[l]):
-                l = lit
-
-        for i in occur[l]:
-            if clauses[i] != clause and subset(clause, clauses[i]):
-                yield i
-
-    def strengthen(clause, lit):
-        return tuple(l for l in clause if l != lit)
-
-    def self_subsume(ci):
-        strengthened = 0
-        for i, lit in enumerate(clauses[ci]):
-            cc = list(clauses[ci])
-            cc[i] = -cc[i]
-            for si in find_subsumed(cc):
-                st = strengthen(clauses[si], cc[i])
-                occur[cc[i]].remove(si)
-                clauses[si] = st
-                strengthened += 1
-        return strengthened
-
-    while True:
-        strengthened = sum(self_subsume(i) for i in range(len(clauses)))
-        if strengthened == 0:
-            break
-
-    new_b = b.__class__(maxvar=b.maxvar)
-    for comment in b.AllComments():
-        new_b.AddComment(comment)
-    for clause in clauses:
-        new_b.Append(clause)
+    # Returns the resolvents to replace v's clauses with, or None if
+    # eliminating v would grow the formula.
+    def resolvents(v):
+        pos, neg = occur[v], occur[-v]
+        if len(pos) > max_occurrences or len(neg) > max_occurrences: return None
+        limit = len(pos) + len(neg)
+        result = []
+        for pi in pos:
+            for ni in neg:
+                r = resolve(clauses[pi], clauses[ni], v)
+                if r is None: continue
+                if len(r) > max_resolvent_size or len(result) == limit: return None
+                result.append(r)
+        return result
+
+    candidates = set(abs(lit) for lit in occur if occur[lit]) - named
+    queue = deque(sorted(candidates, key=lambda v: len(occur[v]) * len(occur[-v])))
+    if eliminated is None: eliminated = set()
+    while queue:
+        v = queue.popleft()
+        candidates.discard(v)
+        if v in eliminated or not (occur[v] or occur[-v]): continue
+        new_clauses = resolvents(v)
+        if new_clauses is None: continue
+        eliminated.add(v)
+        touched = set()
+        for ci in occur[v] | occur[-v]:
+            alive[ci] = False
+            for lit in clauses[ci]:
+                touched.add(abs(lit))
+                if lit not in (v, -v): occur[lit].discard(ci)
+        occur[v], occur[-v] = set(), set()
+        for clause in new_clauses:
+            clauses.append(clause)
+            alive.append(True)
+            for lit in clause:
+                occur[lit].add(len(clauses)-1)
+        # Variables that shared clauses with v might be eliminable now.
+        for u in touched - named - eliminated - candidates:
+            candidates.add(u)
+            queue.append(u)
+
+    new_b = copy_comments(b)
+    for clause, live in zip(clauses, alive):
+        if live: new_b.Append(clause)
     return new_b
 
+# Tarjan's algorithm, with an explicit stack so that long implication chains
+# don't hit the recursion limit. graph maps each node to its successors.
+# Returns the strongly connected components as lists of nodes.
+def strongly_connected_components(graph):
+    index, low = {}, {}
+    stack, on_stack = [], set()
+    components = []
+
+    def visit(node):
+        index[node] = low[node] = len(index)
+        stack.append(node)
+        on_stack.add(node)
+        return (node, iter(graph.get(node, ())))
+
+    for root in list(graph):
+        if root in index: continue
+        work = [visit(root)]
+        while work:
+            node, successors = work[-1]
+            for succ in successors:
+                if succ not in index:
+                    work.append(visit(succ))
+                    break
+                elif succ in on_stack:
+                    low[node] = min(low[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node: break
+                    components.append(component)
+    return components
+
+# Equivalent literal substitution. Every binary clause (a, b) gives the
+# implications -a -> b and -b -> a, and all literals in a strongly connected
+# component of that implication graph are equivalent. Each component is
+# replaced by a single representative literal throughout the formula, where
+# the representative is a named variable whenever the component has one.
+# Other named variables in the component are tied back to the representative
+# with a pair of binary clauses so that extractors still see their values.
+# If a literal and its negation end up in the same component, the formula is
+# unsatisfiable. If eliminated is given, the unnamed variables substituted away
+# are added to that set.
+def substitute_equivalent_literals(b, eliminated=None):
+    named = named_variables(b)
+    graph = defaultdict(list)
+    for clause in b.AllClauses():
+        if len(clause) == 2 and clause[0] != -clause[1]:
+            graph[-clause[0]].append(clause[1])
+            graph[-clause[1]].append(clause[0])
+
+    rep = {}
+    for component in strongly_connected_components(graph):
+        if len(component) == 1 or component[0] in rep: continue
+        vars = set(abs(lit) for lit in component)
+        if len(vars) < len(component):
+            logger().warning('Found a literal equivalent to its negation: the formula is unsatisfiable.')
+            new_b = copy_comments(b)
+            new_b.Append(())
+            return new_b
+        # Prefer named variables, then the lowest variable.
+        r = min(component, key=lambda lit: (abs(lit) not in named, abs(lit)))
+        for lit in component:
+            rep[lit], rep[-lit] = r, -r
+
+    if eliminated is not None:
+        eliminated.update(abs(lit) for lit, r in rep.items() if abs(r) != abs(lit) and abs(lit) not in named)
+    new_b = copy_comments(b)
+    for clause in b.AllClauses():
+        lits = dict.fromkeys(rep.get(lit, lit) for lit in clause)
+        if any(-lit in lits for lit in lits): continue
+        new_b.Append(tuple(lits))
+    for v in sorted(named):
+        r = rep.get(v, v)
+        if r != v:
+            new_b.Append((-v, r))
+            new_b.Append((v, -r))
+    return new_b
+
+# Failed literal probing. For each candidate literal l, assume l and propagate:
+# if that runs into a conflict, -l is implied by the formula and becomes a
+# unit. If both l and -l imply some literal, that literal is implied too.
+# Variables are probed in order of how often they occur, until time_budget
+# seconds or max_probes probes are used up.
+def probe_failed_literals(b, time_budget=None, max_probes=None):
+    propagator = Propagator(b.AllClauses(), b.maxvar)
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+    if propagator.Propagate():
+        counts = defaultdict(int)
+        for lit in propagator.lits:
+            counts[abs(lit)] += 1
+        probes = 0
+        for v in sorted(counts, key=lambda v: -counts[v]):
+            if max_probes is not None and probes >= max_probes: break
+            if deadline is not None and time.perf_counter() > deadline: break
+            if propagator.Value(v) != 0: continue
+            probes += 1
+            implied = []
+            for lit in (v, -v):
+                mark = propagator.Mark()
+                propagator.Assign(lit)
+                failed = not propagator.Propagate()
+                implied.append(set(propagator.trail[mark+1:]))
+                propagator.Backtrack(mark)
+                if failed:
+                    propagator.Assign(-lit)
+                    break
+            else:
+                for lit in implied[0] & implied[1]:
+                    propagator.Assign(lit)
+            if not propagator.Propagate(): break
+    if propagator.conflict:
+        logger().warning('Failed literal probing found a conflict: the formula is unsatisfiable.')
+    return propagator.Apply(copy_comments(b))
 
 def eliminate_blocked_clauses(b, max_iterations=None):
     if max_iterations is None: max_iterations = 30
@@ -179,7 +527,7 @@ def eliminate_blocked_clauses(b, max_iterations=None):
 
         clauses = [c for i,c in enumerate(clauses) if i not in to_remove]
 
-    new_b = b.__class__(maxvar=b.maxvar)
+    new_b = b.Empty()
     for comment in b.AllComments():
         new_b.AddComment(comment)
     for clause in clauses:
@@ -1,4 +1,5 @@
 from collections import deque
+from .cache import key_of
 
 # Generator wrapper, allows simple access to a generator plus a return value.
 # Pattern described here: https://stackoverflow.com/a/34073559/14236095.
@@ -43,6 +44,17 @@ def gather_common_operands(clazz, args):
             queue.extend(arg.args)
     return result
 
+# Drops duplicate operands of an idempotent operation, keeping the first
+# occurrence of each so that the order of the remaining operands is stable.
+def unique_operands(args):
+    result, seen = [], set()
+    for arg in args:
+        key = key_of(arg)
+        if key in seen: continue
+        seen.add(key)
+        result.append(arg)
+    return result
+
 def reduce_evaluated(reducer, args, formula):
     while len(args) > 1:
         reduced = []
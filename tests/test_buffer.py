@@ -1,7 +1,10 @@
 from cnfc.buffer import *
+from array import array
 import io
+import os
 import tempfile
 import unittest
+from unittest import mock
 
 def flush_buffer_to_str(b):
     f = io.StringIO()
@@ -9,7 +12,11 @@ def flush_buffer_to_str(b):
     f.seek(0)
     return f.read()
 
-BUFFER_CLASSES = [MemoryBuffer, FileBuffer]
+# Spills to disk after every couple of clauses.
+class TinyHybridBuffer(HybridBuffer):
+    memory_budget = 40
+
+BUFFER_CLASSES = [MemoryBuffer, ArrayBuffer, FileBuffer, BinaryFileBuffer, HybridBuffer, TinyHybridBuffer]
 
 class TestBuffer(unittest.TestCase):
     def test_basic(self):
@@ -130,3 +137,214 @@ class TestBuffer(unittest.TestCase):
                 '7 0\n'
             )
             self.assertEqual(flush_buffer_to_str(b), expected, clazz.__name__)
+
+    def test_array_buffer_layout(self):
+        b = ArrayBuffer()
+        b.Append((1,-2,3))
+        b.Append(())
+        b.Append((-4,))
+        self.assertEqual(list(b.lits), [1,-2,3,-4])
+        self.assertEqual(list(b.offsets), [0,3,3,4])
+        self.assertEqual(list(b.AllClauses()), [(1,-2,3), (), (-4,)])
+
+        b.PushCheckpoint()
+        b.Append((5,6))
+        b.PopCheckpoint()
+        self.assertEqual(list(b.lits), [1,-2,3,-4])
+        self.assertEqual(list(b.offsets), [0,3,3,4])
+        self.assertEqual(b.num_clauses, 3)
+
+    def test_binary_file_buffer_records_span_chunks(self):
+        b = BinaryFileBuffer()
+        # Force records to straddle chunk boundaries while replaying.
+        b.chunk_size = 8
+        clauses = [(1,-2,3), (), (-4,), (5,6,7,8,9), (10,-11)]
+        for clause in clauses:
+            b.Append(clause)
+        self.assertEqual(list(b.AllClauses()), clauses)
+
+        b.PushCheckpoint()
+        b.Append((12,13))
+        b.PopCheckpoint()
+        self.assertEqual(list(b.AllClauses()), clauses)
+        self.assertEqual(b.maxvar, 11)
+
+    def test_file_buffer_lines_span_chunks(self):
+        b = FileBuffer()
+        b.chunk_size = 5
+        clauses = [(1,-2,3), (), (-4,), (5,6,7,8,9), (10,-11)]
+        for clause in clauses:
+            b.Append(clause)
+        b.Extend(array('i', [12, -13]), [0, 2, 2])
+        self.assertEqual(list(b.AllClauses()), clauses + [(12,-13), ()])
+
+    def test_pop_checkpoint_during_read(self):
+        for clazz in [FileBuffer, BinaryFileBuffer]:
+            b = clazz()
+            b.chunk_size = 64
+            b.Append((1,2))
+            b.PushCheckpoint()
+            for i in range(1000):
+                b.Append((i+3, -(i+4)))
+            clauses = b.AllClauses()
+            self.assertEqual(next(clauses), (1,2), clazz.__name__)
+            b.PopCheckpoint()
+            # The rest of the file is gone, so reading just stops early.
+            self.assertLess(len(list(clauses)), 1000, clazz.__name__)
+            self.assertEqual(list(b.AllClauses()), [(1,2)], clazz.__name__)
+
+    def test_append_after_partial_read(self):
+        for clazz in BUFFER_CLASSES:
+            b = clazz()
+            b.Append((1,2))
+            b.Append((3,))
+            clauses = b.AllClauses()
+            self.assertEqual(next(clauses), (1,2), clazz.__name__)
+            b.Append((4,))
+            clauses.close()
+            self.assertEqual(list(b.AllClauses()), [(1,2), (3,), (4,)], clazz.__name__)
+
+    def test_hybrid_buffer_checkpoints_across_spills(self):
+        b = HybridBuffer(memory_budget=40)
+        b.Append((1,2))
+        b.PushCheckpoint()
+        b.Append((3,))
+        b.Append((4,5,6))  # Spills
+        self.assertEqual(b.spilled_clauses, 3)
+        b.PushCheckpoint()
+        b.Append((7,))
+        b.PushCheckpoint()
+        b.Append((-8,9))
+        b.Append((10,))  # Spills
+        self.assertEqual(b.spilled_clauses, 6)
+        self.assertEqual(list(b.AllClauses()), [(1,2), (3,), (4,5,6), (7,), (-8,9), (10,)])
+
+        b.PopCheckpoint()
+        self.assertEqual(list(b.AllClauses()), [(1,2), (3,), (4,5,6), (7,)])
+        self.assertEqual(b.maxvar, 7)
+        b.Append((11,))
+        self.assertEqual(list(b.AllClauses()), [(1,2), (3,), (4,5,6), (7,), (11,)])
+
+        b.PopCheckpoint()
+        self.assertEqual(list(b.AllClauses()), [(1,2), (3,), (4,5,6)])
+        b.PopCheckpoint()
+        self.assertEqual(list(b.AllClauses()), [(1,2)])
+        self.assertEqual(b.maxvar, 2)
+        self.assertEqual(b.num_clauses, 1)
+
+    def test_flush_to_file(self):
+        expected = (
+            'c var 1 : x\u00e9\n' +
+            'c hello\n' +
+            'p cnf 3 2\n' +
+            '1 -2 0\n' +
+            '3 0\n'
+        )
+        # Exercise the fallbacks when the kernel can't copy for us.
+        unavailable = mock.Mock(side_effect=OSError)
+        patches = [
+            [],
+            [mock.patch.object(os, 'copy_file_range', unavailable, create=True)],
+            [mock.patch.object(os, 'copy_file_range', unavailable, create=True),
+             mock.patch.object(os, 'sendfile', unavailable, create=True)],
+        ]
+        for clazz in BUFFER_CLASSES:
+            for patch in patches:
+                b = clazz()
+                b.AddComment('var 1 : x\u00e9')
+                b.Append((1,-2))
+                b.AddComment('hello')
+                b.Append((3,))
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    path = os.path.join(tmpdir, 'out.cnf')
+                    with open(path, 'w', encoding='utf-8') as f:
+                        for p in patch: p.start()
+                        try:
+                            b.Flush(f)
+                        finally:
+                            for p in patch: p.stop()
+                        f.write('c done\n')
+                    with open(path, encoding='utf-8') as f:
+                        self.assertEqual(f.read(), expected + 'c done\n', clazz.__name__)
+                # Flushing shouldn't disturb later appends.
+                b.Append((4,))
+                self.assertEqual(list(b.AllClauses()), [(1,-2), (3,), (4,)], clazz.__name__)
+
+    def test_parallel_flush(self):
+        for clazz in [MemoryBuffer, ArrayBuffer]:
+            b = clazz()
+            b.flush_chunk_size = 3
+            b.AddComment('hello')
+            for i in range(1, 20):
+                b.Append(tuple((-1)**j * (i+j) for j in range(i % 4)))
+            expected = flush_buffer_to_str(b)
+            self.assertIn('\n 0\n', expected)  # Includes empty clauses
+            for workers in [1, 2, 3]:
+                f = io.StringIO()
+                b.Flush(f, workers=workers)
+                self.assertEqual(f.getvalue(), expected, clazz.__name__)
+
+    def test_format_array_clauses(self):
+        b = ArrayBuffer()
+        for clause in [(1,-2,3), (10,), (-4,5), (6,)]:
+            b.Append(clause)
+        # Format the middle two clauses only.
+        text = format_array_clauses(b.lits[3:6], b.offsets[1:4], 3)
+        self.assertEqual(text, '10 0\n-4 5 0\n')
+
+    def test_extend(self):
+        lits = array('i', [9, 1, -2, 3, 4, -5, 9])
+        offsets = [1, 4, 4, 6]
+        for clazz in BUFFER_CLASSES:
+            b = clazz()
+            b.Append((7,))
+            b.PushCheckpoint()
+            b.Extend(lits, offsets)
+            b.Append((-6,))
+            self.assertEqual(list(b.AllClauses()), [(7,), (1,-2,3), (), (4,-5), (-6,)], clazz.__name__)
+            self.assertEqual(b.maxvar, 7, clazz.__name__)
+            b.PopCheckpoint()
+            self.assertEqual(list(b.AllClauses()), [(7,)], clazz.__name__)
+
+    def test_counting_buffer(self):
+        b = CountingBuffer()
+        b.AddComment('var 1 : x')
+        b.Append((1,-2))
+        b.PushCheckpoint()
+        b.Append((3,))
+        b.Extend(array('i', [4, -5, 6, 7]), [0, 3, 3, 4])
+        self.assertEqual(b.Stats(), {'clauses': 5, 'literals': 7, 'maxvar': 7, 'comments': 1,
+                                     'lengths': {0: 1, 1: 2, 2: 1, 3: 1}})
+        b.PopCheckpoint()
+        self.assertEqual(b.Stats(), {'clauses': 1, 'literals': 2, 'maxvar': 2, 'comments': 1,
+                                     'lengths': {2: 1}})
+        with self.assertRaises(NotImplementedError):
+            b.Flush(io.StringIO())
+
+    def test_empty(self):
+        for clazz in BUFFER_CLASSES + [CountingBuffer]:
+            b = clazz()
+            b.AddComment('hello')
+            b.Append((1,-5))
+            e = b.Empty()
+            self.assertIsInstance(e, clazz)
+            self.assertEqual(e.maxvar, 5, clazz.__name__)
+            self.assertEqual(e.num_clauses, 0, clazz.__name__)
+        b = HybridBuffer(memory_budget=40)
+        self.assertEqual(b.Empty().memory_budget, 40)
+
+    def test_memory_buffer_pop_truncates_in_place(self):
+        b = MemoryBuffer()
+        b.Append((1,))
+        clauses, comments = b.clauses, b.comments
+        for i in range(2, 100):
+            b.PushCheckpoint()
+            b.AddComment('clause {}'.format(i))
+            b.Append((i,))
+        for i in range(2, 100):
+            b.PopCheckpoint()
+        self.assertIs(b.clauses, clauses)
+        self.assertIs(b.comments, comments)
+        self.assertEqual(b.clauses, [(1,)])
+        self.assertEqual(b.comments, [])
+        self.assertEqual(b.maxvar, 1)
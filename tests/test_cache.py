@@ -0,0 +1,207 @@
+from cnfc import *
+from cnfc.cache import ExpressionCache
+from .util import SatTestCase
+
+import gc
+import unittest
+
+class TestCache(unittest.TestCase, SatTestCase):
+    def test_structurally_identical_exprs_are_shared(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+        self.assertIs(And(x, y), And(x, y))
+        self.assertIs(x & ~y, And(x, Literal(y, -1)))
+        self.assertIs(Integer(5) + Tuple(x, y), Integer(5) + Tuple(x, y))
+        self.assertIs(NumTrue(x, y, z) == 2, NumTrue(x, y, z) == 2)
+        self.assertIsNot(NumTrue(x, y, z) == 2, NumTrue(x, y, z) == 1)
+        self.assertIsNot(And(x, y), Or(x, y))
+        self.assertIsNot(And(x, y), And(x, z))
+        self.assertIsNot(Implies(x, y), Implies(y, x))
+
+    def test_vars_with_different_names_arent_shared(self):
+        f, g = Formula(), Formula()
+        x, y = f.AddVars('x y')
+        p, q = g.AddVars('p q')
+        self.assertEqual((x.vid, y.vid), (p.vid, q.vid))
+        self.assertIsNot(And(x, y), And(p, q))
+        self.assertEqual(repr(And(p, q)), 'And(Var(p,1),Var(q,2))')
+
+    def test_sids(self):
+        f = Formula()
+        x, y = f.AddVars('x y')
+        self.assertEqual(x.sid, Literal(x, 1).sid)
+        self.assertNotEqual(x.sid, (~x).sid)
+        self.assertNotEqual(x.sid, y.sid)
+        self.assertNotEqual(BooleanLiteral(True).sid, BooleanLiteral(False).sid)
+        conj = And(x, y)
+        self.assertLess(conj.sid, 0)
+        self.assertEqual(conj.sid, And(x, y).sid)
+        self.assertNotEqual(conj.sid, Or(x, y).sid)
+
+    def test_cache_hit(self):
+        f = Formula()
+        x, y = f.AddVars('x y')
+        v = And(x, y).generate_var(f)
+        nextvar = f.nextvar
+        # The original expression is gone, but rebuilding it still hits the cache.
+        gc.collect()
+        self.assertIs(And(x, y).generate_var(f), v)
+        self.assertEqual(f.nextvar, nextvar)
+
+    def test_commutative_exprs_are_shared(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+        self.assertIs(And(x, y), And(y, x))
+        self.assertIs(Or(x, ~y), Or(~y, x))
+        self.assertIs(Eq(x, y), Eq(y, x))
+        self.assertIs(Neq(x, y), Neq(y, x))
+        a, b = Integer(3), Tuple(x, y)
+        self.assertIs(a + b, b + a)
+        self.assertIs(a * b, b * a)
+        self.assertIs(TupleMax(a, b), TupleMax(b, a))
+        self.assertIs(TupleMin(a, b), TupleMin(b, a))
+        self.assertIsNot(a - b, b - a)
+
+    def test_flatten_and_drop_duplicates(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+        self.assertEqual(And(And(x, y), z).exprs, (x, y, z))
+        self.assertIs(And(And(x, y), z), And(x, And(z, y)))
+        self.assertIs(Or(x, y, x, Or(y, x)), Or(x, y))
+        self.assertIsNot(Or(And(x, y), z), Or(x, y, z))
+        a = Integer(3)
+        self.assertIs(TupleMax(a, a), TupleMax(a))
+        self.assertIsNot(a + a, TupleAdd(a))
+
+    def test_equivalent_exprs_share_a_var(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+        v = And(x, Or(y, z)).generate_var(f)
+        nextvar = f.nextvar
+        self.assertIs(And(Or(z, y, z), x).generate_var(f), v)
+        self.assertEqual(f.nextvar, nextvar)
+
+    def test_complementary_operands(self):
+        f = Formula()
+        x, y = f.AddVars('x y')
+        nextvar = f.nextvar
+        self.assertFalse(And(x, y, ~x).generate_var(f).val)
+        self.assertTrue(Or(Not(And(x, y)), y, And(y, x)).generate_var(f).val)
+        self.assertTrue(Eq(x, Literal(x, 1)).generate_var(f).val)
+        self.assertFalse(Eq(~x, x).generate_var(f).val)
+        self.assertTrue(Neq(y, Not(y)).generate_var(f).val)
+        self.assertEqual(f.nextvar, nextvar)
+        self.assertEqual(list(Or(x, ~x).generate_cnf(f)), [])
+        self.assertEqual(list(And(x, ~x).generate_cnf(f)), [()])
+        self.assertEqual(list(Eq(x, x).generate_cnf(f)), [])
+        self.assertEqual(list(Neq(x, x).generate_cnf(f)), [()])
+
+    def test_evaluate_is_cached(self):
+        f = Formula()
+        a, b = Tuple(*f.AddVars('a1 a2 a3')), Tuple(*f.AddVars('b1 b2 b3'))
+        bits = (a * b + a).evaluate(f)
+        nextvar, num_clauses = f.nextvar, len(f.buffer.clauses)
+        bits.append(None)
+        self.assertEqual((a + a * b).evaluate(f), bits[:-1])
+        self.assertEqual((f.nextvar, len(f.buffer.clauses)), (nextvar, num_clauses))
+        self.assertEqual(NumTrue(a.exprs[0], b.exprs[0]).evaluate(f),
+                         NumTrue(a.exprs[0], b.exprs[0]).evaluate(f))
+
+    def test_evaluate_cache_and_checkpoints(self):
+        f = Formula()
+        a, b = Tuple(*f.AddVars('a1 a2')), Tuple(*f.AddVars('b1 b2'))
+        f.PushCheckpoint()
+        f.Add(a - b == 1)
+        f.Add(a == 3)
+        self.assertSat(f)
+        f.PopCheckpoint()
+        # The bits for a - b were defined by clauses that were just popped, so
+        # they can't be reused.
+        f.Add(a - b == 2)
+        f.Add(b == 2)
+        self.assertUnsat(f)
+
+    def test_cache_stats(self):
+        f = Formula()
+        x, y = f.AddVars('x y')
+        And(x, y).generate_var(f)
+        And(y, x).generate_var(f)
+        Or(x, y).generate_var(f)
+        self.assertEqual(f.expression_cache.Stats(),
+                         {'size': 2, 'max_size': None, 'hits': 1, 'misses': 2, 'evictions': 0})
+
+    def test_lru_eviction(self):
+        f = Formula(expression_cache_size=2)
+        x, y, z = f.AddVars('x y z')
+        a, b, c = And(x, y), And(y, z), And(x, z)
+        va = a.generate_var(f)
+        b.generate_var(f)
+        a.generate_var(f)  # Makes b the least recently used entry.
+        c.generate_var(f)
+        self.assertEqual(len(f.expression_cache), 2)
+        self.assertEqual(f.expression_cache.evictions, 1)
+        self.assertIs(a.generate_var(f), va)
+        nextvar = f.nextvar
+        b.generate_var(f)
+        self.assertEqual(f.nextvar, nextvar + 1)
+
+    def test_custom_cache_class(self):
+        class CountingCache(ExpressionCache):
+            puts = 0
+            def Put(self, expr, value):
+                CountingCache.puts += 1
+                super().Put(expr, value)
+        f = Formula(expression_cache_class=CountingCache)
+        x, y = f.AddVars('x y')
+        f.Add(Or(And(x, y), And(y, x)))
+        self.assertEqual(CountingCache.puts, 1)
+
+    def test_pop_checkpoint_keeps_earlier_entries(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+        v = And(x, y).generate_var(f)
+        f.PushCheckpoint()
+        self.assertIs(And(x, y).generate_var(f), v)
+        w = Or(x, z).generate_var(f)
+        f.PushCheckpoint()
+        Or(y, z).generate_var(f)
+        f.PopCheckpoint()
+        self.assertEqual(len(f.expression_cache), 2)
+        f.PopCheckpoint()
+        self.assertEqual(len(f.expression_cache), 1)
+        nextvar = f.nextvar
+        self.assertIs(And(x, y).generate_var(f), v)
+        self.assertEqual(f.nextvar, nextvar)
+        self.assertIsNot(Or(x, z).generate_var(f), w)
+
+    def test_checkpoint_variants_share_prefix(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+        f.Add(Or(And(x, y), z))
+        for variant in (Not(z), Not(x)):
+            f.PushCheckpoint()
+            f.Add(variant)
+            f.Add(Or(And(y, x), Not(x)))
+            self.assertSat(f)
+            f.PopCheckpoint()
+        f.Add(Not(z))
+        f.Add(Not(x))
+        self.assertUnsat(f)
+
+    def test_analyze_doesnt_leak_entries(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+        f.Analyze(Or(And(x, y), z))
+        f.Add(Or(And(x, y), z))
+        f.Add(Not(z))
+        f.Add(Not(x))
+        self.assertUnsat(f)
+
+    def test_no_cache(self):
+        f = Formula(use_expression_cache=False)
+        x, y = f.AddVars('x y')
+        v = And(x, y).generate_var(f)
+        self.assertNotEqual(And(x, y).generate_var(f).vid, v.vid)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+from cnfc import *
+from .util import SatTestCase
+
+import sys
+import unittest
+
+# Deep enough that a recursive compiler would hit the default recursion limit.
+DEPTH = 2 * sys.getrecursionlimit()
+
+class TestCompiler(unittest.TestCase, SatTestCase):
+    def new_formula(self):
+        return Formula()
+
+    def test_deep_and_or_chain(self):
+        f = self.new_formula()
+        xs = f.AddVars('x', DEPTH)
+        # x0 | (x1 & (x2 | (x3 & ...)))
+        e = xs[-1]
+        for i in reversed(range(len(xs) - 1)):
+            e = Or(xs[i], e) if i % 2 == 0 else And(xs[i], e)
+        f.Add(e)
+        # With every Or'd variable false, all the And'ed ones and the last
+        # variable have to be true.
+        for x in xs[:-1:2]:
+            f.Add(Not(x))
+        self.assertSat(f)
+        f.Add(Not(xs[-1]))
+        self.assertUnsat(f)
+
+    def test_deep_implies_chain(self):
+        f = self.new_formula()
+        xs = f.AddVars('x', DEPTH)
+        # x0 -> (x1 -> (x2 -> ...))
+        e = xs[-1]
+        for x in reversed(xs[:-1]):
+            e = Implies(x, e)
+        f.Add(e)
+        f.Add(Not(xs[-1]))
+        for x in xs[:-2]:
+            f.Add(x)
+        self.assertSat(f)
+        f.Add(xs[-2])
+        self.assertUnsat(f)
+
+    def test_deep_not_chain(self):
+        f = self.new_formula()
+        xs = f.AddVars('x', DEPTH)
+        # Not(x0 & Not(x1 & Not(...)))
+        e = xs[-1]
+        for x in reversed(xs[:-1]):
+            e = Not(And(x, e))
+        f.Add(e)
+        for x in xs[:-1]:
+            f.Add(x)
+        # That leaves an odd number of negations of the last variable.
+        self.assertSat(f)
+        f.Add(xs[-1])
+        self.assertUnsat(f)
+
+    def test_deep_boolean_if_chain(self):
+        f = self.new_formula()
+        xs = f.AddVars('x', DEPTH)
+        # If(x0, If(x1, ..., Not(x1)), Not(x0))
+        e = xs[-1]
+        for x in reversed(xs[:-1]):
+            e = If(x, e, Not(x))
+        f.Add(e)
+        for x in xs[:-1]:
+            f.Add(x)
+        self.assertSat(f)
+        f.Add(Not(xs[-1]))
+        self.assertUnsat(f)
+
+    def test_deep_if_chain(self):
+        f = self.new_formula()
+        xs = f.AddVars('x', DEPTH)
+        # If(x_n, n % 5, If(x_n-1, ... If(x_0, 0, 9)))
+        e = Integer(9)
+        for i, x in enumerate(xs):
+            e = If(x, Integer(i % 5), e)
+        f.PushCheckpoint()
+        f.Add(e == 9)
+        self.assertSat(f)
+        f.Add(xs[7])
+        self.assertUnsat(f)
+        f.PopCheckpoint()
+        f.Add(e == 4)
+        for x in xs[5:]:
+            f.Add(Not(x))
+        f.Add(Not(xs[4]))
+        self.assertUnsat(f)
+
+    def test_shared_subexpressions_compile_once(self):
+        f = self.new_formula()
+        x, y, z = f.AddVars('x y z')
+        shared = Or(And(x, y), z)
+        f.Add(And(Eq(shared, x), Implies(shared, y)))
+        self.assertEqual(f.expression_cache.misses, len(f.expression_cache))
+
+# Compiling operands ahead of time has to work without the cache, and with a
+# cache so small it evicts operands before their parents are generated.
+class TestCompilerWithoutCache(TestCompiler):
+    def new_formula(self):
+        return Formula(use_expression_cache=False)
+
+    def test_shared_subexpressions_compile_once(self):
+        cached = Formula()
+        x, y, z = cached.AddVars('x y z')
+        shared = Or(And(x, y), z)
+        e = And(Eq(shared, x), Implies(shared, y), Or(shared, Not(shared)))
+        cached.Add(e)
+        f = self.new_formula()
+        f.AddVars('x y z')
+        f.Add(e)
+        self.assertEqual(f.nextvar, cached.nextvar)
+        self.assertEqual(f.buffer.num_clauses, cached.buffer.num_clauses)
+
+class TestCompilerWithSmallCache(TestCompilerWithoutCache):
+    def new_formula(self):
+        return Formula(expression_cache_size=2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,17 @@
 from cnfc import *
 from .util import SatTestCase, write_cnf_to_string
+import bz2
+import gzip
+import io
+import json
+import lzma
 import math
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+from unittest import mock
 
 class TestFormula(unittest.TestCase, SatTestCase):
     def test_add_variables(self):
@@ -47,6 +57,18 @@ class TestFormula(unittest.TestCase, SatTestCase):
         self.assertEqual(x.vid, 1)
         self.assertEqual(y.vid, 2)
 
+    def test_literals_are_shared(self):
+        f = Formula()
+        x = f.AddVar('x')
+        self.assertIs(~x, ~x)
+        self.assertIs(~~x, x.generate_var(f))
+        self.assertIs(~~~x, ~x)
+        self.assertEqual(((~x).var, (~x).sign), (x, -1))
+        self.assertIs(BooleanLiteral(True), BooleanLiteral(True))
+        self.assertIs(~BooleanLiteral(True), BooleanLiteral(False))
+        for lit in (x, ~x, BooleanLiteral(False)):
+            self.assertFalse(hasattr(lit, '__dict__'))
+
     def test_integer_to_and_from_vars(self):
         f = Formula()
         bits = 4
@@ -87,6 +109,35 @@ class TestFormula(unittest.TestCase, SatTestCase):
         )
         self.assertEqual(write_cnf_to_string(f), expected)
 
+    def test_raw_clauses_output(self):
+        f = Formula()
+        x,y,z,w = f.AddVars('x y z w')
+        self.assertEqual((int(x), int(~w), (~y).raw), (1, -4, -2))
+        f.AddRawClauses([(1,-4), (-2,3)])
+        f.AddRawClauses([2, 3, -1, 4], offsets=[0, 2, 4], validate=True)
+
+        expected = (
+            'p cnf 4 4\n' +
+            '1 -4 0\n' +
+            '-2 3 0\n' +
+            '2 3 0\n' +
+            '-1 4 0\n'
+        )
+        self.assertEqual(write_cnf_to_string(f), expected)
+
+    def test_raw_clauses_validation(self):
+        f = Formula()
+        x,y = f.AddVars('x y')
+        with self.assertRaises(ValueError):
+            f.AddRawClauses([(1,3)], validate=True)
+        with self.assertRaises(ValueError):
+            f.AddRawClauses([(1,0,2)], validate=True)
+        with self.assertRaises(ValueError):
+            f.AddRawClauses([1,2], offsets=[0,3], validate=True)
+        with self.assertRaises(ValueError):
+            f.AddRawClauses([1,2], offsets=[2,0], validate=True)
+        self.assertEqual(write_cnf_to_string(f), 'p cnf 0 0\n')
+
     def test_basic_disjunction_output(self):
         f = Formula()
         x,y,z,w = f.AddVars('x y z w')
@@ -1465,5 +1516,220 @@ class TestFormula(unittest.TestCase, SatTestCase):
         self.assertUnsat(f)
         f.PopCheckpoint()
 
+    def test_write_compressed_cnf(self):
+        for buffer_class in [MemoryBuffer, FileBuffer]:
+            f = Formula(buffer_class)
+            x, y, z = f.AddVars('x y z')
+            f.Add(x | ~y)
+            f.Add(y | z)
+            plain = io.StringIO()
+            f.WriteCNF(plain)
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                for ext, opener in [('.gz', gzip.open), ('.bz2', bz2.open), ('.xz', lzma.open)]:
+                    path = os.path.join(tmpdir, 'formula.cnf' + ext)
+                    f.WriteCNF(path)
+                    with opener(path, 'rt') as compressed:
+                        self.assertEqual(compressed.read(), plain.getvalue(), ext)
+
+                path = os.path.join(tmpdir, 'formula.cnf')
+                f.WriteCNF(path)
+                with open(path) as uncompressed:
+                    self.assertEqual(uncompressed.read(), plain.getvalue())
+
+                # Explicit compression on an already open text file.
+                with open(path, 'w') as fd:
+                    f.WriteCNF(fd, compression='gzip')
+                with gzip.open(path, 'rt') as compressed:
+                    self.assertEqual(compressed.read(), plain.getvalue())
+
+            out = io.BytesIO()
+            f.WriteCNF(out, compression='bz2')
+            self.assertEqual(bz2.decompress(out.getvalue()).decode(), plain.getvalue())
+
+            with self.assertRaises(ValueError):
+                f.WriteCNF(io.BytesIO(), compression='zip')
+
+            # Uncompressed output to a binary stream.
+            out = io.BytesIO()
+            f.WriteCNF(out)
+            self.assertEqual(out.getvalue().decode(), plain.getvalue())
+            self.assertFalse(out.closed)
+
+            # StringIO has nothing binary to compress into.
+            with self.assertRaises(TypeError):
+                f.WriteCNF(io.StringIO(), compression='gzip')
+
+    def test_write_cnf_with_workers(self):
+        for buffer_class in [MemoryBuffer, ArrayBuffer, FileBuffer, BinaryFileBuffer, HybridBuffer]:
+            f = Formula(buffer_class)
+            x, y, z = f.AddVars('x y z')
+            f.Add(x | ~y)
+            f.Add(Or(y, z) == x)
+            serial, parallel = io.StringIO(), io.StringIO()
+            f.WriteCNF(serial)
+            f.WriteCNF(parallel, workers=2)
+            self.assertEqual(parallel.getvalue(), serial.getvalue(), buffer_class.__name__)
+
+    @unittest.skipUnless(os.path.exists('/dev/stdin'), 'needs /dev/stdin')
+    def test_solve(self):
+        millisat = [sys.executable, os.path.join(os.path.dirname(__file__), 'millisat.py'), '/dev/stdin']
+        for buffer_class in [MemoryBuffer, FileBuffer]:
+            f = Formula(buffer_class)
+            x, y, z = f.AddVars('x y z')
+            f.Add(x | y)
+            f.Add(~x)
+            f.Add(If(y, ~z))
+            sol = f.Solve(millisat)
+            self.assertEqual((sol['x'], sol['y'], sol['z']), (False, True, False))
+            f.Add(z | x)
+            self.assertIsNone(f.Solve(millisat))
+
+        with self.assertRaises(RuntimeError):
+            Formula().Solve([sys.executable, '-c', 'import sys; sys.exit(3)'])
+
+    def test_solve_unknown(self):
+        f = Formula()
+        x, y = f.AddVars('x y')
+        f.Add(x | y)
+        for script in ['print("s UNKNOWN")', 'print("c nothing to report")']:
+            with self.assertRaises(RuntimeError):
+                f.Solve([sys.executable, '-c', script])
+
+    def test_solve_solver_quits_early(self):
+        f = Formula()
+        xs = f.AddVars('x', 1000)
+        for i in range(100):
+            f.Add(Or(*xs))
+        # Exits without reading its input, so writing to it fails.
+        script = 'print("s UNSATISFIABLE"); import sys; sys.exit(20)'
+        procs = []
+        popen = subprocess.Popen
+        def record(*args, **kwargs):
+            procs.append(popen(*args, **kwargs))
+            return procs[-1]
+        with mock.patch.object(subprocess, 'Popen', record):
+            self.assertIsNone(f.Solve([sys.executable, '-c', script]))
+        self.assertTrue(procs[0].stdin.closed)
+
+    def test_write_cubed_cnf(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+        f.AddClause(x, y)
+        f.AddClause(~y, z)
+
+        out = io.StringIO()
+        f.WriteCubedCnf(out, vars=[x, ~z])
+        expected = (
+            'c var 1 : x\n' +
+            'c var 2 : y\n' +
+            'c var 3 : z\n' +
+            'p inccnf\n' +
+            '1 2 0\n' +
+            '-2 3 0\n' +
+            'a 1 -3 0\n' +
+            'a 1 3 0\n' +
+            'a -1 -3 0\n' +
+            'a -1 3 0\n'
+        )
+        self.assertEqual(out.getvalue(), expected)
+
+        out = io.StringIO()
+        f.WriteCubedCnf(out, cubes=[[~x, ~z], [y]])
+        self.assertTrue(out.getvalue().endswith('-2 3 0\na -1 -3 0\na 2 0\n'))
+
+        with self.assertRaises(ValueError):
+            f.WriteCubedCnf(io.StringIO())
+
+    def test_profile(self):
+        f = Formula(profile=True)
+        x, y, z = f.AddVars('x y z')
+        a, b = Integer(*f.AddVars('a', 3)), Integer(*f.AddVars('b', 3))
+        f.Add(Or(x, y), label='ors')
+        f.Add(Or(y, z), label='ors')
+        f.Add(And(x, Or(y, z)))
+        f.Add(a // b == 2, label='div')
+
+        entries = {(e.expression, e.label): e for e in f.profiler.Report()}
+        ors = entries[('Or', 'ors')]
+        self.assertEqual((ors.adds, ors.clauses, ors.vars, ors.cache_hits), (2, 2, 0, 0))
+        ands = entries[('And', None)]
+        self.assertEqual((ands.adds, ands.clauses, ands.vars), (1, 5, 1))
+        # The constraints added while evaluating a // b count towards the
+        # top-level Add.
+        div = entries[('TupleEq', 'div')]
+        self.assertEqual(div.adds, 1)
+        self.assertEqual(div.vars, f.nextvar - 11)
+        self.assertEqual(sum(e.clauses for e in entries.values()), len(f.buffer.clauses))
+        self.assertEqual(f.profiler.Report()[0], div)
+
+        out = io.StringIO()
+        f.WriteProfile(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0].split(), ['expression', 'label', 'adds', 'clauses', 'vars', 'cache', 'hits', 'seconds'])
+        self.assertEqual(lines[1].split()[:2], ['TupleEq', 'div'])
+        self.assertEqual(len(lines), 4)
+
+        out = io.StringIO()
+        f.WriteProfile(out, fmt='json', sort_by='adds')
+        report = json.loads(out.getvalue())
+        self.assertEqual(report[0]['label'], 'ors')
+        self.assertEqual(report[0]['adds'], 2)
+
+        with self.assertRaises(ValueError):
+            Formula().WriteProfile(io.StringIO())
+
+    def test_profile_ignores_analyze(self):
+        f = Formula(profile=True)
+        x, y, z = f.AddVars('x y z')
+        f.Add(Or(x, y), label='ors')
+        f.Analyze(Or(y, z))
+        f.Analyze(And(x, z), dry_run=True)
+        self.assertEqual([(e.expression, e.label, e.adds) for e in f.profiler.Report()], [('Or', 'ors', 1)])
+        # Profiling is back on afterwards.
+        f.Add(And(x, z))
+        self.assertEqual(len(f.profiler.Report()), 2)
+
+    def test_analyze_dry_run(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+        expr = And(x, Or(y, z), Implies(x, z))
+        stats = f.Analyze(expr, dry_run=True)
+        self.assertEqual(stats, {'clauses': 9, 'literals': 17, 'maxvar': 5, 'new_vars': 2,
+                                 'lengths': {1: 3, 2: 4, 3: 2}})
+        # Nothing was added to the formula itself.
+        self.assertEqual(write_cnf_to_string(f), 'p cnf 0 0\n')
+        self.assertEqual(f.Analyze(expr)['clauses'], stats['clauses'])
+        # Not even the variables generated for expr.
+        self.assertEqual(f.nextvar, 4)
+        f.Add(Or(And(x, y), z))
+        self.assertEqual(f.buffer.maxvar, 4)
+
+    def test_analyze_failure(self):
+        f = Formula(profile=True)
+        x, y = f.AddVars('x y')
+        buffer = f.buffer
+        class Broken(BoolExpr):
+            __hash__ = object.__hash__
+            def generate_var(self, formula):
+                formula.AddVar()
+                raise RuntimeError('broken')
+        with self.assertRaises(RuntimeError):
+            f.Analyze(And(Or(x, y), Broken()), dry_run=True)
+        self.assertIs(f.buffer, buffer)
+        self.assertIsNotNone(f.profiler)
+        self.assertEqual(f.nextvar, 3)
+        self.assertEqual(f.expression_cache.scopes, [])
+
+    def test_counting_buffer_formula(self):
+        f = Formula(buffer_class=CountingBuffer)
+        xs = f.AddVars('x', 10)
+        f.Add(NumTrue(*xs) == 3)
+        g = Formula()
+        xs = g.AddVars('x', 10)
+        g.Add(NumTrue(*xs) == 3)
+        self.assertEqual(f.buffer.Stats()['clauses'], len(g.buffer.clauses))
+        self.assertEqual(f.buffer.Stats()['maxvar'], g.buffer.maxvar)
+
 if __name__ == '__main__':
     unittest.main()
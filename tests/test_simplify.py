@@ -1,8 +1,9 @@
 from cnfc import *
 from cnfc.simplify import *
 from cnfc.formula import raw_lit
-from .util import write_cnf_to_string
+from .util import satisfiable, write_cnf_to_string
 
+import itertools
 import unittest
 
 class TestSimplify(unittest.TestCase):
@@ -24,6 +25,16 @@ class TestSimplify(unittest.TestCase):
 
         self.assertClausesEquivalent(f, [(x1,), (x2, x3), (~x4,)])
 
+    def test_unit_propagation_max_iterations_deprecated(self):
+        f = Formula()
+        x1, x2 = f.AddVars('x1 x2')
+        f.AddClause(x1)
+        f.AddClause(~x1, x2)
+        with self.assertWarns(DeprecationWarning):
+            f.buffer = propagate_units(f.buffer, max_iterations=1)
+        # Still propagates all the way.
+        self.assertClausesEquivalent(f, [(x1,), (x2,)])
+
     def test_unit_propagation_repeated(self):
         f = Formula()
         x1, x2, x3, x4, x5 = f.AddVars('x1 x2 x3 x4 x5')
@@ -38,6 +49,52 @@ class TestSimplify(unittest.TestCase):
 
         self.assertClausesEquivalent(f, [(x1,), (x2,), (~x3,), (x4, x5)])
 
+    def test_unit_propagation_long_chain(self):
+        f = Formula()
+        xs = f.AddVars('x', 20000)
+
+        # x0 -> x1 -> ... -> x19999 takes one pass per link to resolve by
+        # repeatedly rewriting the buffer.
+        for x, y in reversed(list(zip(xs, xs[1:]))):
+            f.AddClause(~x, y)
+        f.AddClause(xs[0])
+
+        f.buffer = propagate_units(f.buffer)
+
+        self.assertClausesEquivalent(f, [(x,) for x in xs])
+
+    def test_unit_propagation_conflict(self):
+        f = Formula()
+        x1, x2, x3 = f.AddVars('x1 x2 x3')
+
+        f.AddClause(x1)
+        f.AddClause(~x1, x2)
+        f.AddClause(~x2, x3)
+        f.AddClause(~x3, ~x1)
+        f.AddClause(x2, x3)
+
+        with self.assertLogs('cnfc.log', level='WARNING'):
+            f.buffer = propagate_units(f.buffer)
+
+        self.assertEqual(list(f.buffer.AllClauses()), [()])
+        self.assertEqual(list(f.buffer.AllComments()), ['var 1 : x1', 'var 2 : x2', 'var 3 : x3'])
+
+    def test_propagator_backtrack(self):
+        p = Propagator([(1, 2, 3), (-1, 4), (-4, -2), (-3, 5), (-1, 2, 3), (-1, -5)])
+        self.assertTrue(p.Propagate())
+        mark = p.Mark()
+        p.Assign(1)
+        self.assertFalse(p.Propagate())
+        p.Backtrack(mark)
+        self.assertEqual(p.trail, [])
+        p.Assign(-1)
+        p.Assign(-2)
+        self.assertTrue(p.Propagate())
+        self.assertEqual(p.trail, [-1, -2, 3, 5])
+        # Moving watches around only reorders literals within clauses.
+        self.assertEqual([sorted(c) for c in p.Clauses()],
+                         [[1, 2, 3], [-1, 4], [-4, -2], [-3, 5], [-1, 2, 3], [-5, -1]])
+
     def test_self_subsumption(self):
         f = Formula()
         x1, x2, x3 = f.AddVars('x1 x2 x3')
@@ -61,6 +118,237 @@ class TestSimplify(unittest.TestCase):
 
         self.assertClausesEquivalent(f, [(x1, x2), (x1, x3), (x2, x4)])
 
+    def test_subsumption(self):
+        f = Formula()
+        x1, x2, x3, x4 = f.AddVars('x1 x2 x3 x4')
+
+        f.AddClause(x1, x2, x3)  # Subsumed by (x1, x2)
+        f.AddClause(x2, x1)
+        f.AddClause(x4, x3, x2, x1)  # Subsumed by (x1, x2)
+        f.AddClause(x1, x2)  # Duplicate
+        f.AddClause(x3, ~x4)
+
+        f.buffer = eliminate_subsumed(f.buffer)
+
+        self.assertClausesEquivalent(f, [(x1, x2), (x3, ~x4)])
+
+    def test_subsumption_after_strengthening(self):
+        f = Formula()
+        x1, x2, x3, x4 = f.AddVars('x1 x2 x3 x4')
+
+        # (x1, x2, ~x3) is strengthened to (x1, x2) by (x1, x3), which then
+        # subsumes (x1, x2, x4).
+        f.AddClause(x1, x2, x4)
+        f.AddClause(x1, x2, ~x3)
+        f.AddClause(x1, x3)
+
+        f.buffer = eliminate_subsumed(f.buffer)
+
+        self.assertClausesEquivalent(f, [(x1, x2), (x1, x3)])
+
+    def test_subsumption_with_units(self):
+        f = Formula()
+        x1, x2, x3 = f.AddVars('x1 x2 x3')
+
+        f.AddClause(x1)
+        f.AddClause(x1, x2, x3)
+        f.AddClause(~x1, x2)
+        f.AddClause(~x1, ~x2, x3)
+
+        f.buffer = eliminate_subsumed(f.buffer)
+
+        self.assertClausesEquivalent(f, [(x1,), (x2,), (x3,)])
+
+    def test_subsumption_with_tautologies(self):
+        f = Formula()
+        x1, x2 = f.AddVars('x1 x2')
+
+        f.AddClause(x1, ~x1)
+        f.AddClause(x1, x2)
+
+        f.buffer = eliminate_subsumed(f.buffer)
+
+        self.assertClausesEquivalent(f, [(x1, x2)])
+
+    # Checks that f and g agree on which assignments to the named variables
+    # can be extended to a solution.
+    def assertSameProjection(self, f, g, names):
+        for values in itertools.product([True, False], repeat=len(names)):
+            results = []
+            for formula in (f, g):
+                formula.buffer.PushCheckpoint()
+                for name, val in zip(names, values):
+                    formula.buffer.Append((formula.vars[name] if val else -formula.vars[name],))
+                results.append(satisfiable(write_cnf_to_string(formula)))
+                formula.buffer.PopCheckpoint()
+            self.assertEqual(results[0], results[1], values)
+
+    def test_variable_elimination(self):
+        def build():
+            f = Formula()
+            a, b, c, d = f.AddVars('a b c d')
+            f.Add(Or(And(a, b), And(c, ~d), Eq(a, d)))
+            f.Add(Implies(And(b, c), Or(a, d)))
+            f.Add(Integer(a, b) + Integer(c, d) != Integer(1))
+            return f
+
+        f, g = build(), build()
+        g.buffer = eliminate_variables(g.buffer)
+
+        named = named_variables(f.buffer)
+        remaining = set(abs(lit) for clause in g.buffer.AllClauses() for lit in clause)
+        self.assertLess(len(g.buffer.clauses), len(f.buffer.clauses))
+        self.assertLess(len(remaining - named), f.nextvar - 1 - len(named))
+        self.assertEqual(g.buffer.maxvar, f.buffer.maxvar)
+        self.assertSameProjection(f, g, ['a', 'b', 'c', 'd'])
+
+    def test_variable_elimination_keeps_named_vars(self):
+        f = Formula()
+        x, y = f.AddVars('x y')
+        z = f.AddVar()
+
+        f.AddClause(x, y)
+        f.AddClause(~x, z)
+        f.AddClause(~z, y)
+
+        f.buffer = eliminate_variables(f.buffer)
+
+        self.assertClausesEquivalent(f, [(x, y), (~x, y)])
+
+    def test_simplify_eliminating_aux_vars(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+        f.Add(Or(And(x, y), And(y, z), And(x, z)))
+        f.Simplify(eliminate_aux_vars=True, substitute_equivalences=True)
+        self.assertEqual(len(f.expression_cache), 0)
+        # Cached gates can't be reused since their clauses might be gone.
+        f.Add(Not(And(x, y)))
+        f.Add(Not(And(y, z)))
+        f.Add(x)
+        f.Add(y)
+        with self.assertLogs('cnfc.log', level='WARNING'):
+            f.Simplify()
+        self.assertEqual(list(f.buffer.AllClauses()), [()])
+
+    def test_eliminated_variables_cannot_be_reused(self):
+        f = Formula()
+        x = f.AddVar('x')
+        a = f.AddVar()
+        f.Add(Eq(a, x))
+        f.Simplify(eliminate_aux_vars=True)
+        self.assertEqual(f.eliminated_vars, {a.vid})
+        # a's definition is gone, so constraining it now would be unsound.
+        with self.assertRaises(ValueError):
+            f.Add(a)
+        with self.assertRaises(ValueError):
+            f.AddRawClauses([(-a.vid, 1)])
+        f.Add(~x)
+
+    def test_substituted_variables_cannot_be_reused(self):
+        f = Formula()
+        x = f.AddVar('x')
+        a = f.AddVar()
+        f.Add(Eq(a, x))
+        f.Simplify(substitute_equivalences=True)
+        self.assertEqual(f.eliminated_vars, {a.vid})
+        with self.assertRaises(ValueError):
+            f.Add(a)
+        f.Add(~x)
+
+    def test_equivalent_literal_substitution(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+        a, b = f.AddVar(), f.AddVar()
+
+        # a == ~x, b == a, z == b: all of them collapse onto x.
+        f.AddClause(a, x)
+        f.AddClause(~a, ~x)
+        f.AddClause(~a, b)
+        f.AddClause(~b, a)
+        f.AddClause(~b, z)
+        f.AddClause(~z, b)
+        f.AddClause(a, y, b)
+
+        f.buffer = substitute_equivalent_literals(f.buffer)
+
+        # z is named, so it's tied to its representative.
+        self.assertClausesEquivalent(f, [(~x, y), (~z, ~x), (z, x)])
+
+    def test_equivalent_literal_substitution_projection(self):
+        def build():
+            f = Formula()
+            a, b, c = f.AddVars('a b c')
+            f.Add(Eq(And(a, b), Or(b, c)))
+            f.Add(Or(Eq(a, Not(Or(b, c))), And(a, c)))
+            return f
+
+        f, g = build(), build()
+        g.buffer = substitute_equivalent_literals(g.buffer)
+        self.assertSameProjection(f, g, ['a', 'b', 'c'])
+
+    def test_equivalent_literal_substitution_unsat(self):
+        f = Formula()
+        x, y = f.AddVars('x y')
+
+        f.AddClause(~x, y)
+        f.AddClause(~y, ~x)
+        f.AddClause(x, ~y)
+        f.AddClause(y, x)
+
+        with self.assertLogs('cnfc.log', level='WARNING'):
+            f.buffer = substitute_equivalent_literals(f.buffer)
+
+        self.assertEqual(list(f.buffer.AllClauses()), [()])
+
+    def test_strongly_connected_components_long_cycle(self):
+        n = 100000
+        graph = dict((i, [(i + 1) % n]) for i in range(n))
+        graph[n] = [0]
+        components = strongly_connected_components(graph)
+        self.assertEqual(sorted(len(c) for c in components), [1, n])
+
+    def test_failed_literal_probing(self):
+        f = Formula()
+        x, y, z, w = f.AddVars('x y z w')
+
+        # Assuming x leads to a conflict through y and z, so ~x is implied.
+        f.AddClause(~x, y)
+        f.AddClause(~y, z)
+        f.AddClause(~y, ~z)
+        f.AddClause(x, w, z)
+
+        f.buffer = probe_failed_literals(f.buffer)
+
+        self.assertClausesEquivalent(f, [(~x,), (~y,), (w, z)])
+
+    def test_failed_literal_probing_both_polarities(self):
+        f = Formula()
+        x, y, z = f.AddVars('x y z')
+
+        # Both x and ~x imply y.
+        f.AddClause(~x, y)
+        f.AddClause(x, z)
+        f.AddClause(~z, y)
+        f.AddClause(~y, x, z)
+
+        f.buffer = probe_failed_literals(f.buffer)
+
+        self.assertClausesEquivalent(f, [(y,), (x, z), (x, z)])
+
+    def test_failed_literal_probing_budget(self):
+        f = Formula()
+        x, y = f.AddVars('x y')
+
+        f.AddClause(~x, y)
+        f.AddClause(~x, ~y)
+
+        b = probe_failed_literals(f.buffer, max_probes=0)
+        self.assertEqual(sorted(b.AllClauses()), [(-1, -2), (-1, 2)])
+        b = probe_failed_literals(f.buffer, time_budget=0)
+        self.assertEqual(sorted(b.AllClauses()), [(-1, -2), (-1, 2)])
+        f.Simplify(probe=True, probe_time_budget=10)
+        self.assertClausesEquivalent(f, [(~x,)])
+
     # simplify currently does a few simplifications, so we have to be a little
     # careful in the tests below to create minimal examples that exercise only
     # the simplification we're interested in. For example, the following test
@@ -119,3 +407,35 @@ class TestSimplify(unittest.TestCase):
         f.buffer = simplify(f.buffer)
 
         self.assertClausesEquivalent(f, [(~x3,), (~x1, ~x2)])
+
+    def test_simplify_other_buffers(self):
+        # The last one spills to disk after every couple of clauses.
+        for clazz, args in [(ArrayBuffer, {}), (BinaryFileBuffer, {}), (HybridBuffer, {}),
+                            (HybridBuffer, {'memory_budget': 40})]:
+            f = Formula(buffer_class=clazz, buffer_args=args)
+            x1, x2, x3, x4 = f.AddVars('x1 x2 x3 x4')
+
+            f.AddClause(x1, x2, ~x3)
+            f.AddClause(x1, x3)
+            f.AddClause(x1)
+            f.AddClause(x2, x3, x4)
+            f.AddClause(~x4)
+            f.AddClause(~x1, x2, x2)
+
+            f.Simplify()
+
+            self.assertIsInstance(f.buffer, clazz)
+            self.assertClausesEquivalent(f, [(x1,), (x2,), (~x4,)])
+
+    def test_simplify_keeps_buffer_args(self):
+        f = Formula(buffer_class=HybridBuffer, buffer_args={'memory_budget': 40})
+        x1, x2, x3, x4 = f.AddVars('x1 x2 x3 x4')
+        f.AddClause(x1, x2, ~x3)
+        f.AddClause(x1, x3)
+        f.AddClause(x2, x3, x4)
+        f.AddClause(~x4)
+
+        f.Simplify(eliminate_aux_vars=True, substitute_equivalences=True, probe=True)
+
+        self.assertEqual(f.buffer.memory_budget, 40)
+        self.assertClausesEquivalent(f, [(x1,), (x2,), (~x4,)])